@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+
+@dataclass(frozen=True)
+class Budget:
+    """Hard limits of a run, None means unlimited."""
+
+    calls: int | None = None
+    tokens: int | None = None
+    seconds: float | None = None
+
+    def allows(self, calls: int, tokens: int, seconds: float) -> bool:
+        """Check whether usage stays within all limits."""
+        return (
+            (self.calls is None or calls <= self.calls)
+            and (self.tokens is None or tokens <= self.tokens)
+            and (self.seconds is None or seconds <= self.seconds)
+        )
+
+
+class BudgetExceeded(RuntimeError):
+    """Raised instead of a model call once the budget of the run is spent."""
+
+
+@dataclass
+class BudgetMeter:
+    """Usage of a run, checked against its budget before every model call."""
+
+    budget: Budget
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def exceeded(self) -> bool:
+        """Whether one more call would go over the budget."""
+        return not self.budget.allows(self.calls + 1, self.tokens, self.elapsed)
+
+    def check(self) -> None:
+        """Reserve a call.
+
+        Raises:
+            BudgetExceeded: If the budget of the run is spent.
+        """
+        if self.exceeded:
+            raise BudgetExceeded(f"Budget exceeded: {self.report()}")
+        self.calls += 1
+
+    def add(self, usage: Any) -> None:
+        """Count tokens from the `usage` of a completion."""
+        if usage is not None:
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.completion_tokens += usage.completion_tokens or 0
+
+    def report(self) -> str:
+        return (
+            f"{self.calls} calls, {self.prompt_tokens} prompt + "
+            f"{self.completion_tokens} completion tokens, {self.elapsed:.1f}s"
+        )
+
+
+current_meter: ContextVar[BudgetMeter | None] = ContextVar(
+    "current_meter", default=None
+)
+"""Budget meter of the running task, calls are unlimited when None."""
+
+
+@contextmanager
+def metered(budget: Budget | None) -> Iterator[BudgetMeter | None]:
+    """Meter the model calls of the enclosed block against a budget.
+
+    Args:
+        budget (Budget | None): Budget of the block, None doesn't meter.
+
+    Yields:
+        BudgetMeter | None: Meter of the block.
+    """
+    if budget is None:
+        yield None
+        return
+    meter = BudgetMeter(budget)
+    token = current_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        current_meter.reset(token)
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+from pathlib import Path
+from typing import IO, Any, Awaitable, Callable, TypeVar
+
+
+T = TypeVar("T")
+
+
+class Cache:
+    """Key-value cache of JSON-serializable values.
+
+    Values are kept in memory and, if a path is given, appended to a JSON
+    lines file, so the cache survives between runs and can be shared by
+    concurrent readers.
+    """
+
+    def __init__(self, path: str | Path | None = None) -> None:
+        self.path = Path(path) if path is not None else None
+        self.data: dict[str, Any] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self._file: IO[str] | None = None
+        if self.path is not None and self.path.exists():
+            with self.path.open() as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.data[entry["key"]] = entry["value"]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get a cached value, counting hits and misses."""
+        if key in self.data:
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: str, value: Any) -> None:
+        """Cache a value (and persist it if the cache has a path)."""
+        self.data[key] = value
+        if self.path is not None:
+            if self._file is None:
+                self._file = self.path.open("a")
+            self._file.write(json.dumps({"key": key, "value": value}) + "\n")
+            # readers of the file see the entry right away
+            self._file.flush()
+
+    def close(self) -> None:
+        """Close the file the cache appends to, it's reopened on the next `set`."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """Stable hash key of JSON-serializable parts."""
+        payload = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls into a single one.
+
+    While a call with a given key is running, further calls with the
+    same key wait for its result instead of running again. The call runs
+    as a task of its own, so a caller being cancelled doesn't affect the
+    others; it's cancelled only once all of its callers are.
+    """
+
+    def __init__(self) -> None:
+        self.in_flight: dict[str, asyncio.Task] = {}
+        self.waiters: dict[asyncio.Task, int] = {}
+        self.coalesced: int = 0
+
+    async def run(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """Run a call unless an identical one is already running.
+
+        Args:
+            key (str): Key identifying the call, see `Cache.key`.
+            call (Callable[[], Awaitable[T]]): Call to run.
+
+        Returns:
+            T: Result of the call (or of the identical running one).
+        """
+        if (task := self.in_flight.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(call())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self._done(key, task))
+
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                if not task.done():
+                    # every caller gave up, nobody needs the result anymore
+                    task.cancel()
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
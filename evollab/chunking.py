@@ -0,0 +1,220 @@
+import random
+import re
+import zlib
+from collections import defaultdict, deque
+from typing import Iterable, Iterator
+
+from .tokens import count_tokens
+
+
+def iter_segments(lines: Iterable[str]) -> Iterator[str]:
+    """Split a stream of lines into sentences, keeping paragraph breaks.
+
+    Args:
+        lines (Iterable[str]): Lines of a document, may be a lazy stream.
+
+    Yields:
+        str: Sentences (or empty strings marking paragraph breaks).
+    """
+    for line in lines:
+        if not line.strip():
+            yield ""
+            continue
+        for sentence in re.split(r"(?<=[.!?])\s+", line.strip()):
+            if sentence:
+                yield sentence
+
+
+def iter_chunks(
+    lines: Iterable[str],
+    max_tokens: int = 1024,
+    overlap: int = 128,
+) -> Iterator[str]:
+    """Split a document into token-bounded, overlapping chunks.
+
+    The document is consumed lazily, only the current chunk is kept
+    in memory. Chunks end at sentence boundaries where possible and
+    start with the trailing sentences (up to `overlap` tokens) of the
+    previous chunk.
+
+    Args:
+        lines (Iterable[str]): Lines of a document, may be a lazy stream.
+        max_tokens (int, optional): Maximum tokens of a chunk. Defaults to 1024.
+        overlap (int, optional): Tokens shared by neighbouring chunks. Defaults to 128.
+
+    Yields:
+        str: Chunks of the document.
+    """
+    if overlap >= max_tokens:
+        raise ValueError("Overlap must be smaller than the chunk size.")
+
+    chunk: deque[tuple[str, int]] = deque()
+    size: int = 0
+    fresh: bool = False
+
+    def render() -> str:
+        text = " ".join(s if s else "\n\n" for s, _ in chunk)
+        return re.sub(r" ?\n\n ?", "\n\n", text).strip()
+
+    for segment in iter_segments(lines):
+        tokens = _tokens(segment)
+
+        # split sentences that alone don't fit into a chunk
+        if tokens > max_tokens - overlap:
+            parts = _split(segment, max_tokens - overlap, tokens)
+        else:
+            parts = [segment]
+
+        for part in parts:
+            part_tokens = _tokens(part)
+            if size + part_tokens > max_tokens and fresh:
+                yield render()
+                # keep the tail of the chunk as an overlap
+                for _ in range(len(chunk) - _tail_length(chunk, overlap)):
+                    size -= chunk.popleft()[1]
+                fresh = False
+            chunk.append((part, part_tokens))
+            size += part_tokens
+            fresh = fresh or bool(part)
+
+    if fresh:
+        yield render()
+
+
+def _tokens(segment: str) -> int:
+    # tokens a segment adds to a chunk, with the space or paragraph break
+    # joining it, so the counts of the segments add up to the chunk's
+    return count_tokens(f" {segment}" if segment else "\n\n")
+
+
+def _split(text: str, limit: int, tokens: int) -> list[str]:
+    # split by words (or characters, for a single long word) at the estimated
+    # size, then again any part the estimate still left too long
+    words = text.split()
+    if len(words) > 1:
+        step = max(1, len(words) * limit // tokens)
+        parts = [" ".join(words[i : i + step]) for i in range(0, len(words), step)]
+    else:
+        step = max(1, len(text) * limit // tokens)
+        parts = [text[i : i + step] for i in range(0, len(text), step)]
+
+    result: list[str] = []
+    for part in parts:
+        part_tokens = _tokens(part)
+        if part_tokens > limit and part != text:
+            result.extend(_split(part, limit, part_tokens))
+        else:
+            result.append(part)
+    return result
+
+
+def _tail_length(chunk: deque[tuple[str, int]], overlap: int) -> int:
+    kept, length = 0, 0
+    for _, tokens in reversed(chunk):
+        if kept + tokens > overlap:
+            break
+        kept += tokens
+        length += 1
+    return length
+
+
+def shingles(text: str, n: int = 3) -> set[tuple[str, ...]]:
+    """Word n-grams of a normalized text."""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < n:
+        return {tuple(words)}
+    return {tuple(words[i : i + n]) for i in range(len(words) - n + 1)}
+
+
+class Deduplicator:
+    """Streaming near-duplicate filter based on MinHash signatures of word shingles.
+
+    Signatures are indexed by LSH bands, so a text is only compared with
+    the seen texts sharing a band with it, and only the latest `capacity`
+    texts are remembered. Memory and time per text stay bounded however
+    long the stream is.
+
+    Args:
+        threshold (float, optional): Jaccard similarity from which a text is
+            a duplicate. Defaults to 0.7.
+        num_perm (int, optional): Size of a signature. Defaults to 64.
+        bands (int, optional): LSH bands of a signature, more bands find
+            less similar candidates. Defaults to 16.
+        capacity (int, optional): Texts remembered. Defaults to 100_000.
+        seed (int, optional): Seed of the hash permutations. Defaults to 0.
+    """
+
+    prime: int = (1 << 61) - 1
+
+    def __init__(
+        self,
+        threshold: float = 0.7,
+        num_perm: int = 64,
+        bands: int = 16,
+        capacity: int = 100_000,
+        seed: int = 0,
+    ) -> None:
+        if num_perm % bands:
+            raise ValueError("Signature size must be a multiple of the bands.")
+        rng = random.Random(seed)
+        self.threshold = threshold
+        self.permutations = [
+            (rng.randrange(1, self.prime), rng.randrange(self.prime))
+            for _ in range(num_perm)
+        ]
+        self.rows = num_perm // bands
+        self.capacity = capacity
+        self.signatures: dict[int, tuple[int, ...]] = {}
+        self.buckets: defaultdict[tuple[int, tuple[int, ...]], set[int]]
+        self.buckets = defaultdict(set)
+        self.order: deque[int] = deque()
+        self._ids = 0
+
+    def signature(self, text: str) -> tuple[int, ...]:
+        """MinHash signature of the shingles of a text."""
+        hashes = [zlib.crc32(" ".join(s).encode("utf-8")) for s in shingles(text)]
+        return tuple(
+            min((a * h + b) % self.prime for h in hashes)
+            for a, b in self.permutations
+        )
+
+    def _bands(self, signature: tuple[int, ...]) -> Iterator[tuple[int, tuple]]:
+        for i in range(0, len(signature), self.rows):
+            yield i, signature[i : i + self.rows]
+
+    def is_duplicate(self, text: str) -> bool:
+        """Check whether a text is a near-duplicate of one seen before.
+
+        Texts which aren't duplicates are remembered for further checks.
+
+        Args:
+            text (str): Text to check.
+
+        Returns:
+            bool: True if the estimated Jaccard similarity to a seen text
+                reaches the threshold.
+        """
+        current = self.signature(text)
+        bands = list(self._bands(current))
+        candidates = set().union(*(self.buckets.get(band, ()) for band in bands))
+        for other in candidates:
+            signature = self.signatures[other]
+            same = sum(1 for x, y in zip(current, signature) if x == y)
+            if same / len(current) >= self.threshold:
+                return True
+
+        self._ids += 1
+        self.signatures[self._ids] = current
+        for band in bands:
+            self.buckets[band].add(self._ids)
+        self.order.append(self._ids)
+        if len(self.order) > self.capacity:
+            self._forget(self.order.popleft())
+        return False
+
+    def _forget(self, id: int) -> None:
+        for band in self._bands(self.signatures.pop(id)):
+            bucket = self.buckets[band]
+            bucket.discard(id)
+            if not bucket:
+                del self.buckets[band]
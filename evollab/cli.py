@@ -1,18 +1,37 @@
 import asyncio
+import json
+from dataclasses import asdict, replace
 from functools import wraps
 from pathlib import Path
-from typing import Any, Callable
+from typing import Any, Callable, Iterable
 
 import click
 import halo
 
-from . import commands, models, prompts
+from . import commands, datasets, models, planner, prompts, sampling, tasks, tracing
+from .budget import Budget
+from .cache import Cache
+from .config import EvolConfig
+from .hedging import Hedger
+from .lineage import MethodStore
+from .routing import Router
+from .server import Server
 
 
 def in_asyncio_run(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        return asyncio.run(f(*args, **kwargs))
+        config = click.get_current_context().obj.get("config", EvolConfig())
+
+        async def main():
+            try:
+                with commands.connected(config.client, config.hedger):
+                    return await f(*args, **kwargs)
+            finally:
+                if config.hedger is not None:
+                    await config.hedger.aclose()
+
+        return asyncio.run(main())
 
     return wrapper
 
@@ -58,14 +77,49 @@ spinner_settings: dict[str, Any] = {
     help="Number of generations to produce",
     default=1,
 )
+@click.option(
+    "--structured-output",
+    help="Request structured output with a JSON schema, a tool call, or not at all",
+    type=click.Choice(["json_schema", "tools", "off"]),
+    default="json_schema",
+)
 @click.option(
     "--silent",
     help="Display spinner during generation process",
     is_flag=True,
     default=False,
 )
+@click.option(
+    "--routes",
+    help="TOML or JSON file routing stages to models",
+    type=click.Path(exists=True, path_type=Path),
+)
+@click.option(
+    "--hedge",
+    help="Duplicate calls slower than the p95 latency of their stage",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--hedge-budget",
+    help="Maximum ratio of duplicated calls",
+    default=0.05,
+)
 @click.pass_context
-def cli(ctx, model, output_format, temperature, top_p, seed, n, silent):
+def cli(
+    ctx,
+    model,
+    output_format,
+    temperature,
+    top_p,
+    seed,
+    n,
+    structured_output,
+    silent,
+    routes,
+    hedge,
+    hedge_budget,
+):
     ctx.ensure_object(dict)
     ctx.obj["silent"] = silent
     ctx.obj["args"] = models.LLMArgs(
@@ -75,14 +129,29 @@ def cli(ctx, model, output_format, temperature, top_p, seed, n, silent):
         top_p=top_p,
         seed=seed,
         n=n,
+        structured_output=structured_output,
     )
+    if routes is not None:
+        router = Router.load(routes, fallback=ctx.obj["args"])
+    else:
+        router = Router.default(fallback=ctx.obj["args"])
+    config = ctx.obj["config"] = EvolConfig(router=router)
+    if hedge:
+        config.hedger = Hedger(budget=hedge_budget)
+        ctx.call_on_close(lambda: click.echo(config.hedger.report(), err=True))
 
 
-async def run_simple_task(ctx: click.Context, task: Callable, text: str, *args) -> Any:
-    llm_args = ctx.obj.get("args", models.LLMArgs.default())
+async def run_simple_task(
+    ctx: click.Context, task: Callable, text: Any, *args, **kwargs
+) -> Any:
+    router = ctx.obj.get("config", EvolConfig()).router
+    stage = task.__name__.removesuffix("_batch")
     silent = ctx.obj.get("silent", True)
     with halo.Halo(**spinner_settings, enabled=not silent):
-        result = await task(text, *args, args=llm_args)
+        result = await router.run(
+            stage,
+            lambda llm_args: task(text, *args, args=llm_args, **kwargs),
+        )
     return result
 
 
@@ -100,12 +169,107 @@ def parse_text_arg(text: str | None = None) -> str:
     return text
 
 
+def iter_text_arg(text: str | None = None) -> Iterable[str]:
+    if text is not None:
+        return text.splitlines()
+    stdin = click.get_text_stream("stdin")
+    if stdin.isatty():
+        raise click.MissingParameter(
+            message="Expected as argument or at stdin.",
+            param_hint="'TEXT'",
+            param_type="argument",
+        )
+    # stream lines instead of reading the whole stdin
+    return stdin
+
+
+def dataset_options(f):
+    f = click.option(
+        "-i",
+        "--input",
+        "input_path",
+        help="Dataset to read (JSON, JSON lines, CSV or text, optionally gzipped)",
+        type=click.Path(allow_dash=True),
+    )(f)
+    f = click.option("--field", help="Text field of a record", default="text")(f)
+    f = click.option("--id-field", help="Field holding the id of a record")(f)
+    f = click.option(
+        "-o",
+        "--output",
+        "output_path",
+        help="Dataset to write atomically (JSON, JSON lines, CSV or text)",
+        type=click.Path(allow_dash=True),
+    )(f)
+    return f
+
+
+def iter_dataset_arg(
+    text: str | None,
+    input_path: str | None,
+    field: str = "text",
+    id_field: str | None = None,
+) -> Iterable[str | datasets.Record]:
+    if input_path is None:
+        return (line.strip() for line in iter_text_arg(text) if line.strip())
+    return datasets.read_records(input_path, field=field, id_field=id_field)
+
+
+def open_output(output_path: str | None) -> datasets.DatasetWriter:
+    if output_path is None:
+        # rows are echoed as soon as they are ready
+        return datasets.DatasetWriter("-", chunk_size=1)
+    return datasets.DatasetWriter(output_path)
+
+
+def document_options(f):
+    f = click.option(
+        "--document",
+        help="Process the text in token-bounded chunks",
+        is_flag=True,
+    )(f)
+    f = click.option("--chunk-tokens", help="Maximum tokens of a chunk", default=1024)(f)
+    f = click.option("--overlap", help="Tokens shared by neighbouring chunks", default=128)(f)
+    f = click.option("--concurrency", help="Chunks processed at once", default=4)(f)
+    f = click.option("--dedupe", help="Skip near-duplicate outputs", is_flag=True)(f)
+    return f
+
+
+async def run_document_task(
+    ctx: click.Context,
+    task: Callable,
+    text: str | None,
+    chunk_tokens: int,
+    overlap: int,
+    concurrency: int,
+    dedupe: bool,
+) -> None:
+    async for output in tasks.process_document(
+        iter_text_arg(text),
+        command=task,
+        max_tokens=chunk_tokens,
+        overlap=overlap,
+        concurrency=concurrency,
+        dedupe=dedupe,
+        config=ctx.obj.get("config", EvolConfig()),
+    ):
+        click.echo(output)
+
+
 @cli.command()
 @click.pass_context
 @click.argument("text", required=False)
+@document_options
 @in_asyncio_run
-async def augment(ctx: click.Context, text: str | None = None) -> None:
+async def augment(
+    ctx: click.Context,
+    text: str | None = None,
+    document: bool = False,
+    **document_kwargs,
+) -> None:
     """Augment, by filling missing info or entities, to provided text."""
+    if document:
+        await run_document_task(ctx, commands.augment, text, **document_kwargs)
+        return
     result = await run_simple_task(
         ctx,
         commands.augment,
@@ -118,28 +282,68 @@ async def augment(ctx: click.Context, text: str | None = None) -> None:
 @click.pass_context
 @click.argument("text", required=False)
 @click.option("-c", "--classes", multiple=True)
+@click.option("--batch", help="Classify each line of the text", is_flag=True)
+@click.option("--batch-size", help="Number of texts per prompt", default=20)
+@click.option("--prefilter", help="Label class name mentions locally", is_flag=True)
+@click.option("--cache", "cache_path", help="Labels cache file", type=click.Path())
+@dataset_options
 @in_asyncio_run
 async def classify(
     ctx: click.Context,
     text: str | None = None,
-    classes: tuple[str] | None = None,
+    classes: tuple[str] = (),
+    batch: bool = False,
+    batch_size: int = 20,
+    prefilter: bool = False,
+    cache_path: str | None = None,
+    input_path: str | None = None,
+    field: str = "text",
+    id_field: str | None = None,
+    output_path: str | None = None,
 ) -> None:
     """Classify a provided text."""
-    result = await run_simple_task(
-        ctx,
-        commands.classify,
-        parse_text_arg(text),
-        classes,
-    )
-    click.echo(result)
+    if not classes:
+        raise click.UsageError("Expected at least one class (-c/--classes).")
+    if not batch:
+        result = await run_simple_task(
+            ctx,
+            commands.classify,
+            parse_text_arg(text),
+            list(classes),
+        )
+        click.echo(json.dumps(result))
+        return
+
+    with open_output(output_path) as output:
+        async for item, labels in tasks.classify_stream(
+            iter_dataset_arg(text, input_path, field, id_field),
+            list(classes),
+            batch_size=batch_size,
+            cache=Cache(cache_path) if cache_path else None,
+            prefilter=prefilter,
+            config=ctx.obj.get("config", EvolConfig()),
+        ):
+            if isinstance(item, datasets.Record):
+                output.write({"id": item.id, "text": item.text, "labels": labels})
+            else:
+                output.write({"text": item, "labels": labels})
 
 
 @cli.command()
 @click.pass_context
 @click.argument("text", required=False)
+@document_options
 @in_asyncio_run
-async def derive(ctx: click.Context, text: str | None = None) -> None:
+async def derive(
+    ctx: click.Context,
+    text: str | None = None,
+    document: bool = False,
+    **document_kwargs,
+) -> None:
     """Derive an instruction from a provided text."""
+    if document:
+        await run_document_task(ctx, commands.derive, text, **document_kwargs)
+        return
     result = await run_simple_task(
         ctx,
         commands.derive,
@@ -165,16 +369,198 @@ async def answer(ctx: click.Context, text: str | None) -> None:
 @cli.command()
 @click.pass_context
 @click.argument("text", required=False)
+@click.option("--steps", help="Number of evolution steps", default=1)
+@click.option("--no-early-stop", help="Evolve all steps", is_flag=True)
 @in_asyncio_run
-async def evolve(ctx: click.Context, text: str | None = None):
+async def evolve(
+    ctx: click.Context,
+    text: str | None = None,
+    steps: int = 1,
+    no_early_stop: bool = False,
+):
     """Evolve an instruction using a method."""
     result = await run_simple_task(
         ctx,
         commands.evolve,
         parse_text_arg(text),
+        steps=steps,
+        early_stop=not no_early_stop,
     )
     for step in result.steps:
         click.echo(step)
+    if result.stop_reason is not None:
+        click.echo(f"evolution stopped early: {result.stop_reason}", err=True)
+
+
+@cli.command()
+@click.pass_context
+@click.argument("text", required=False)
+@click.option("--concurrency", help="Passages processed at once", default=8)
+@click.option("--cache", "cache_path", help="Stage results cache file", type=click.Path())
+@click.option("--low", help="Overlap below which a pair is rejected", default=0.2)
+@click.option("--high", help="Overlap above which a pair is accepted", default=0.5)
+@click.option("--all", "keep_all", help="Output also unverified pairs", is_flag=True)
+@dataset_options
+@in_asyncio_run
+async def backtranslate(
+    ctx: click.Context,
+    text: str | None = None,
+    concurrency: int = 8,
+    cache_path: str | None = None,
+    low: float = 0.2,
+    high: float = 0.5,
+    keep_all: bool = False,
+    input_path: str | None = None,
+    field: str = "text",
+    id_field: str | None = None,
+    output_path: str | None = None,
+) -> None:
+    """Derive, answer and verify instructions from passages (one per line)."""
+    with open_output(output_path) as output:
+        async for pair in tasks.backtranslate(
+            iter_dataset_arg(text, input_path, field, id_field),
+            concurrency=concurrency,
+            cache=Cache(cache_path) if cache_path else None,
+            low=low,
+            high=high,
+            config=ctx.obj.get("config", EvolConfig()),
+        ):
+            if pair.verified or keep_all:
+                row = asdict(pair)
+                if pair.id is None:
+                    del row["id"]
+                output.write(row)
+
+
+@cli.command()
+@click.pass_context
+@click.option("--host", help="Address to listen on", default="127.0.0.1")
+@click.option("--port", help="Port to listen on", default=8765)
+@click.option("--concurrency", help="Commands running at once", default=16)
+@click.option("--cache", "cache_path", help="Response cache file", type=click.Path())
+@in_asyncio_run
+async def serve(
+    ctx: click.Context,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    concurrency: int = 16,
+    cache_path: str | None = None,
+) -> None:
+    """Serve commands over HTTP for other local services."""
+    server = Server(
+        config=ctx.obj.get("config", EvolConfig()),
+        concurrency=concurrency,
+        cache=Cache(cache_path) if cache_path else Cache(),
+    )
+    await server.serve(host, port)
+
+
+@cli.command("evolve-method")
+@click.pass_context
+@click.argument("instructions", type=click.Path(exists=True, allow_dash=True))
+@click.option("--field", help="Instruction field of a record", default="text")
+@click.option("--dev-set", "dev_set_path", type=click.Path(path_type=Path))
+@click.option("--seed", type=int, default=None)
+@click.option(
+    "--strata",
+    type=click.Choice(["none", "length", "category"]),
+    default=EvolConfig.dev_set_strata,
+)
+@click.option("-c", "--classes", multiple=True)
+@click.option("--store", "store_path", help="Method store database", type=click.Path())
+@click.option("--warm-start", help="Start from the k best stored methods", default=0)
+@click.option(
+    "--trace",
+    "trace_path",
+    help="Write a Chrome trace of the run (open in Perfetto)",
+    type=click.Path(path_type=Path),
+)
+@click.option("--max-calls", help="Budget of model calls", type=int)
+@click.option("--max-tokens", help="Budget of prompt and completion tokens", type=int)
+@click.option("--max-seconds", help="Budget of wall time", type=float)
+@click.option("--plan", help="Only print the estimated cost of the run", is_flag=True)
+@click.option("--task-timeout", help="Seconds a batch or evaluation may take", type=float)
+@click.option("--max-failures", help="Failed batches or evaluations tolerated", type=int)
+@in_asyncio_run
+async def evolve_method(
+    ctx: click.Context,
+    instructions: str,
+    field: str = "text",
+    dev_set_path: Path | None = None,
+    seed: int | None = None,
+    strata: sampling.Strata = "length",
+    classes: tuple[str] = (),
+    store_path: str | None = None,
+    warm_start: int = 0,
+    trace_path: Path | None = None,
+    max_calls: int | None = None,
+    max_tokens: int | None = None,
+    max_seconds: float | None = None,
+    plan: bool = False,
+    task_timeout: float | None = None,
+    max_failures: int | None = None,
+) -> None:
+    """Evolve a method over instructions (one per line, or JSON/CSV) of a file."""
+    config: EvolConfig = ctx.obj.get("config", EvolConfig())
+    config.task_timeout, config.max_failures = task_timeout, max_failures
+    config.dev_set_strata, config.dev_set_classes = strata, list(classes)
+    if (max_calls, max_tokens, max_seconds) != (None, None, None):
+        config.budget = Budget(calls=max_calls, tokens=max_tokens, seconds=max_seconds)
+    tracer = tracing.Tracer() if trace_path is not None else None
+    if store_path is not None:
+        config.store = MethodStore(store_path)
+    if dev_set_path is not None and dev_set_path.exists():
+        dev_set = sampling.DevSet.load(dev_set_path)
+    else:
+        with tracing.recording(tracer):
+            texts = datasets.read_texts(instructions, field=field)
+            dev_set = await sampling.build_dev_set(
+                (text.strip() for text in texts),
+                size=config.development_set_size,
+                reserve_size=config.dev_set_reserve_size,
+                seed=seed,
+                strata=config.dev_set_strata,
+                classes=config.dev_set_classes,
+                args=config.router.args("classify"),
+            )
+        if dev_set_path is not None:
+            dev_set.save(dev_set_path)
+
+    if plan:
+        costs = planner.measure_costs(dev_set.instructions, config)
+        planned = replace(config, development_set_size=len(dev_set.instructions))
+        if config.budget is not None:
+            try:
+                planned, estimate = planner.fit_config(planned, config.budget, costs)
+            except (planner.EmptyDevSet, planner.BudgetTooSmall) as e:
+                raise click.UsageError(str(e))
+        else:
+            estimate = planner.estimate_run(planned, costs)
+        click.echo(
+            f"{planned.development_set_size} instructions, "
+            f"{planned.total_evol_steps} evolution steps, "
+            f"{planned.total_optm_steps} optimization steps: {estimate}"
+        )
+        return
+
+    try:
+        with tracing.recording(tracer):
+            method = await tasks.evolve_method(
+                [],
+                dev_set=dev_set,
+                warm_start=warm_start,
+                config=config,
+            )
+    except (planner.EmptyDevSet, planner.BudgetTooSmall) as e:
+        raise click.UsageError(str(e))
+    finally:
+        if tracer is not None:
+            tracer.save(trace_path)
+            click.echo(tracer.report(), err=True)
+    if dev_set_path is not None:
+        # persist instructions the development set has grown by
+        dev_set.save(dev_set_path)
+    click.echo(method.data)
 
 
 if __name__ == "__main__":
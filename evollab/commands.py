@@ -1,18 +1,96 @@
+import asyncio
 import json
 import re
-from typing import Any, AsyncGenerator, Iterable
-
-from openai import AsyncOpenAI
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Iterable, Iterator
+
+from openai import (
+    APIStatusError,
+    AsyncOpenAI,
+    BadRequestError,
+    UnprocessableEntityError,
+)
 from openai.types.chat import ChatCompletionMessageParam
 
-from . import prompts
+from . import prompts, tracing
+from .budget import current_meter
+from .cache import Cache, SingleFlight
+from .chunking import shingles
+from .hedging import Hedger
 from .models import (
     LLMArgs,
     Method,
     OutputFormat,
+    Schema,
+    StructuredOutput,
     Template,
     Trajectory,
 )
+from .routing import current_stage, parse_errors
+
+
+current_client: ContextVar[AsyncOpenAI | None] = ContextVar(
+    "current_client", default=None
+)
+"""Client of the running task, a default one shared by the process when None."""
+
+current_hedger: ContextVar[Hedger | None] = ContextVar("current_hedger", default=None)
+"""Hedging of the running task, calls aren't hedged when None."""
+
+_default_client: AsyncOpenAI | None = None
+
+single_flight: SingleFlight | None = SingleFlight()
+"""Sharing of identical in-flight calls, disabled when None."""
+
+unstructured_models: set[str] = set()
+"""Models which rejected a structured output request, they use the prompt format."""
+
+structured_params: tuple[str, ...] = (
+    "response_format",
+    "json_schema",
+    "tools",
+    "tool_choice",
+    "structured output",
+)
+"""Request parameters a structured output request may be rejected for."""
+
+
+def get_client() -> AsyncOpenAI:
+    """Client of the running task, see `connected`."""
+    global _default_client
+    if (client := current_client.get()) is not None:
+        return client
+    if _default_client is None:
+        _default_client = AsyncOpenAI()
+    return _default_client
+
+
+@contextmanager
+def connected(
+    client: AsyncOpenAI | None = None,
+    hedger: Hedger | None = None,
+) -> Iterator[None]:
+    """Make the calls of the enclosed block use a client and a hedger.
+
+    Tasks started in the block inherit both, so runs with different
+    clients or hedging (e.g. of different `EvolConfig`) can share a process.
+
+    Args:
+        client (AsyncOpenAI | None, optional): Client of the calls, None
+            uses the default client.
+        hedger (Hedger | None, optional): Hedging of the calls, None
+            doesn't hedge.
+    """
+    client_token = current_client.set(client)
+    hedger_token = current_hedger.set(hedger)
+    try:
+        yield
+    finally:
+        current_hedger.reset(hedger_token)
+        current_client.reset(client_token)
 
 
 async def autochain(
@@ -20,19 +98,162 @@ async def autochain(
     *,
     model: str,
     output_format: OutputFormat = "text",
+    structured_output: StructuredOutput = "json_schema",
+    schema: Schema | None = None,
     **model_kwargs,
 ) -> AsyncGenerator[Any, None]:
-    result = await AsyncOpenAI().chat.completions.create(
-        messages=messages,
-        model=model,
-        **model_kwargs,
+    """Request chat completions and yield the output of each choice.
+
+    With a schema, the output is requested as structured JSON (with a
+    JSON-schema response format or a forced tool call) and yielded
+    parsed. Models rejecting the request fall back to the format of the
+    prompt itself, and their output is yielded per `output_format`.
+
+    Args:
+        messages (Iterable[ChatCompletionMessageParam]): Messages to complete.
+        model (str): Model to use.
+        output_format (OutputFormat, optional): Format of unstructured output.
+        structured_output (StructuredOutput, optional): How a structured
+            output is requested. Defaults to "json_schema".
+        schema (Schema | None, optional): Schema of a structured output.
+
+    Yields:
+        Any: Output of each choice.
+    """
+    messages = list(messages)
+    structured = (
+        schema is not None
+        and structured_output != "off"
+        and model not in unstructured_models
     )
+    request_kwargs = dict(model_kwargs)
+    if structured and structured_output == "tools":
+        request_kwargs["tools"] = [schema.tool()]
+        request_kwargs["tool_choice"] = {
+            "type": "function",
+            "function": {"name": schema.name},
+        }
+    elif structured:
+        request_kwargs["response_format"] = schema.response_format()
+    client = get_client()
+
+    async def create() -> Any:
+        # metered per request sent, so duplicates of a hedged call count too
+        if (meter := current_meter.get()) is not None:
+            meter.check()
+        result = await client.chat.completions.create(
+            messages=messages,
+            model=model,
+            **request_kwargs,
+        )
+        if meter is not None:
+            meter.add(getattr(result, "usage", None))
+        return result
+
+    async def request() -> Any:
+        start = time.perf_counter()
+        try:
+            if (hedger := current_hedger.get()) is not None:
+                return await hedger.run(f"{current_stage.get()}:{model}", create)
+            return await create()
+        finally:
+            call.attributes["network"] = time.perf_counter() - start
+
+    with tracing.span(current_stage.get(), "call", model=model) as call:
+        try:
+            if single_flight is not None:
+                # output format is applied per caller, the completion itself is
+                # shared, only between callers of the same client (runs can have
+                # their own, see `connected`)
+                key = Cache.key(id(client), messages, model, request_kwargs)
+                coalesced = key in single_flight.in_flight
+                call.attributes["cache"] = "coalesced" if coalesced else "miss"
+                result = await single_flight.run(key, request)
+            else:
+                result = await request()
+        except (BadRequestError, UnprocessableEntityError) as e:
+            # other rejections (e.g. context length, content filter) aren't
+            # about the model lacking structured output
+            if not structured or not rejects_structured_output(e):
+                raise
+            unstructured_models.add(model)
+            result = None
+        else:
+            # tokens of a coalesced call are already counted by its leader
+            usage = getattr(result, "usage", None)
+            if usage is not None and call.attributes.get("cache") != "coalesced":
+                call.attributes["prompt_tokens"] = usage.prompt_tokens
+                call.attributes["completion_tokens"] = usage.completion_tokens
+        call.attributes["wait"] = call.duration - call.attributes.get("network", 0.0)
+
+    if result is None:
+        # the model doesn't support structured output, use the prompt format
+        async for output in autochain(
+            messages,
+            model=model,
+            output_format=output_format,
+            **model_kwargs,
+        ):
+            yield output
+        return
+
     for choice in result.choices:
         content = choice.message.content
-        if output_format == "json":
-            # TODO: implement proper json parsing
-            yield json.loads(content)
-        yield content
+        if structured:
+            if tool_calls := getattr(choice.message, "tool_calls", None):
+                content = tool_calls[0].function.arguments
+            yield parse_json(content or "")
+        elif output_format == "json":
+            yield parse_json(content)
+        else:
+            yield content
+
+
+def rejects_structured_output(error: APIStatusError) -> bool:
+    """Check whether a request was rejected for its structured output.
+
+    Args:
+        error (APIStatusError): Error of the rejected request.
+
+    Returns:
+        bool: True if the error is about the response format or the tools.
+    """
+    if error.param:
+        return any(param in error.param for param in structured_params)
+    text = f"{error.message} {error.body}".lower()
+    return any(param in text for param in structured_params)
+
+
+def parse_json(text: str) -> Any:
+    """Parse JSON from a model output, tolerating fences, prose and comments.
+
+    Args:
+        text (str): Text to parse JSON from.
+
+    Returns:
+        Any: Parsed JSON value.
+
+    Raises:
+        ValueError: If no JSON value can be parsed from the text.
+    """
+    if fenced := re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL):
+        text = fenced.group(1)
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if not starts:
+        raise ValueError(f"No JSON found in: {text[:100]!r}")
+    text = text[min(starts) :]
+
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text)
+        return value
+    except json.JSONDecodeError:
+        pass
+
+    # drop `//` comments and trailing commas, both common in model outputs
+    text = re.sub(r"^\s*//.*$", "", text, flags=re.MULTILINE)
+    text = re.sub(r",(\s*[\]}])", r"\1", text)
+    value, _ = json.JSONDecoder().raw_decode(text)
+    return value
 
 
 def extract_steps(text: str) -> list[dict[str, str]]:
@@ -59,18 +280,98 @@ def extract_steps_headers(text: str) -> list[str]:
     return re.findall(r"^Step\s*\d*\s\#[\w\s]*\#", text, re.MULTILINE)
 
 
+refusal_patterns: tuple[str, ...] = (
+    "i'm sorry",
+    "i am sorry",
+    "sorry, i",
+    "i'm unable to",
+    "i am unable to",
+    "i cannot help",
+    "i can't help",
+    "i cannot assist",
+    "i can't assist",
+    "as an ai",
+)
+"""Beginnings of evolved instructions which are refusals, not instructions."""
+
+min_new_shingles: int = 5
+"""Fewest word trigrams absent from the previous stage for a stage to not be
+a duplicate of it. Counted rather than a similarity ratio, so a few added
+sentences still count as new however long the instruction already is."""
+
+
+def check_evolution(previous: str, current: str) -> str | None:
+    """Check locally whether an evolution step failed or saturated.
+
+    Args:
+        previous (str): Instruction of the previous stage.
+        current (str): Instruction of the current stage.
+
+    Returns:
+        str | None: Reason to stop the evolution, None if it may continue.
+    """
+    text = current.strip().lower()
+    if not text:
+        return "empty instruction"
+    if text.startswith(refusal_patterns):
+        return "refusal instead of an instruction"
+    if "#instruction#" in text or "#rewritten instruction#" in text:
+        return "template echoed instead of an instruction"
+
+    if len(shingles(current) - shingles(previous)) < min_new_shingles:
+        return "duplicate of the previous stage"
+    if len(current.split()) <= len(previous.split()):
+        return "no growth in complexity"
+    return None
+
+
+def check_method(method: Method) -> str | None:
+    """Check locally whether a method keeps the structure of an evolution method.
+
+    Args:
+        method (Method): Method to check.
+
+    Returns:
+        str | None: Reason the method is broken, None if it's usable.
+    """
+    text = method.data
+    if not text.strip():
+        return "empty method"
+    if "=== " in text:
+        return "optimization prompt echoed in the method"
+    try:
+        method.format(instruction="")
+    except (KeyError, IndexError, ValueError):
+        return "method can't be formatted"
+
+    steps = list(re.finditer(r"^\s*Step\s*(\d+)", text, re.MULTILINE))
+    if len(steps) < 2:
+        return "missing steps"
+    if "#Finally Rewritten Instruction#" not in text[steps[-1].start() :]:
+        return "#Finally Rewritten Instruction# is not the last step"
+    return None
+
+
 async def evolve(
     instruction: str,
     steps: int = 1,
     method: Method = Method(prompts.initial_method),
     args: LLMArgs = LLMArgs.default(),
+    early_stop: bool = True,
 ) -> Trajectory:
     """Evolve instruction multiple times over a method.
 
+    Each step evolves the instruction of the previous step. With early
+    stopping, the evolution stops at the first step `check_evolution`
+    rejects, and the reason is kept in `Trajectory.stop_reason`.
+
     Args:
         method (Method): Initial method to evolve the instruction.
         instruction (str): Instruction to evolve.
         steps (int, optional): Number of evolution steps. Defaults to 1.
+        args (LLMArgs, optional): Language model arguments
+        early_stop (bool, optional): Stop evolving a failed or saturated
+            instruction. Defaults to True.
 
     Returns:
         Trajectory: Evolution trajectory of the instruction.
@@ -86,12 +387,13 @@ async def evolve(
     # seq evolution of the instruction
     # the `n` parameter doesn't apply here
     for _ in range(steps):
+        previous = trajectory.evolution[-1]
         async for instr in autochain(
             messages=prompts.evolve.format(
-                instruction=instruction,
-                method=method,
+                instruction=previous,
+                method=method.data,
             ),
-            **args.__dict__,
+            **{**args.__dict__, "n": 1},
         ):
             # post-process instruction if steps headers are present
             if steps_headers := extract_steps_headers(instr):
@@ -101,6 +403,10 @@ async def evolve(
 
             trajectory.add(instr)
 
+        if early_stop and (reason := check_evolution(previous, trajectory.evolution[-1])):
+            trajectory.stop_reason = reason
+            break
+
     return trajectory
 
 
@@ -158,9 +464,101 @@ async def answer(text: str, args: LLMArgs) -> str:
     return ""
 
 
+async def judge(
+    passage: str,
+    instruction: str,
+    response: str,
+    args: LLMArgs,
+) -> float:
+    """Judge agreement of a response with the passage it was derived from.
+
+    Args:
+        passage (str): Source passage.
+        instruction (str): Instruction derived from the passage.
+        response (str): Response to the instruction.
+        args (LLMArgs): Language model arguments
+
+    Returns:
+        float: Agreement score between 0 and 1.
+
+    Raises:
+        ValueError: If the judgement can't be parsed.
+    """
+    async for verdict in autochain(
+        messages=prompts.judge.format(
+            passage=passage,
+            instruction=instruction,
+            response=response,
+        ),
+        **{**args.__dict__, "output_format": "json", "n": 1},
+        schema=prompts.judge_schema,
+    ):
+        score = float(verdict["score"])
+        return min(max((score - 1) / 4, 0.0), 1.0)
+    raise ValueError("No judgement returned")
+
+
+def parse_labels(text: str, classes: Iterable[str]) -> list[str]:
+    """Extract known classes mentioned in a classification answer.
+
+    Args:
+        text (str): Classification answer.
+        classes (Iterable[str]): Known classes.
+
+    Returns:
+        list[str]: Mentioned classes, in order of their first mention.
+    """
+    _, _, final = text.rpartition("#Final Classes List#")
+    final = (final or text).lower()
+    mentioned = [
+        (m.start(), c)
+        for c in classes
+        if (m := re.search(rf"\b{re.escape(c.lower())}\b", final))
+    ]
+    return [c for _, c in sorted(mentioned)]
+
+
+def validate_labels(labels: Any, classes: Iterable[str]) -> list[str]:
+    """Keep only known classes, normalized to their canonical spelling.
+
+    Args:
+        labels (Any): Labels returned by the model.
+        classes (Iterable[str]): Known classes.
+
+    Returns:
+        list[str]: Valid, deduplicated labels.
+    """
+    if isinstance(labels, str):
+        labels = [labels]
+    if not isinstance(labels, list):
+        return []
+    canonical = {c.strip().lower(): c for c in classes}
+    valid = (canonical.get(str(label).strip().lower()) for label in labels)
+    return list(dict.fromkeys(label for label in valid if label is not None))
+
+
+def keyword_classify(text: str, classes: Iterable[str]) -> list[str] | None:
+    """Classify a text locally by looking for class names in it.
+
+    Only meant for simple class sets, where a class name appearing in
+    the text is a reliable signal (e.g. languages, products, tickers).
+
+    Args:
+        text (str): Text to classify.
+        classes (Iterable[str]): Known classes.
+
+    Returns:
+        list[str] | None: Matched classes, None if nothing matched.
+    """
+    return parse_labels(text, classes) or None
+
+
 async def classify(text: str, classes: list[str], args: LLMArgs) -> list[str]:
     """Classify a text.
 
+    With `args.n` greater than 1, the classes chosen by the majority
+    of the generations are returned.
+
     Args:
         text (str): Text to classify.
         classes (list[str]): List of classes to classify the text.
@@ -168,13 +566,122 @@ async def classify(text: str, classes: list[str], args: LLMArgs) -> list[str]:
 
     Returns:
         list[str]: List of classes the text belongs to.
+
+    Raises:
+        ValueError: If there are no classes.
     """
+    if not classes:
+        raise ValueError("No classes to classify into")
+    votes: Counter[str] = Counter()
+    num_answers: int = 0
     async for answer in autochain(
         messages=prompts.classify.format(
             text=text,
             classes="\n".join(classes),
         ),
         **args.__dict__,
+        schema=prompts.classify_schema(classes),
     ):
-        return answer
-    return [""]
+        num_answers += 1
+        if isinstance(answer, dict):
+            votes.update(validate_labels(answer.get("classes"), classes))
+        else:
+            votes.update(parse_labels(answer, classes))
+    return [c for c, v in votes.most_common() if v * 2 > num_answers]
+
+
+async def classify_batch(
+    texts: list[str],
+    classes: list[str],
+    args: LLMArgs,
+    *,
+    batch_size: int = 20,
+    concurrency: int = 4,
+    cache: Cache | None = None,
+    prefilter: bool = False,
+) -> list[list[str]]:
+    """Classify many texts, packing multiple texts into a single prompt.
+
+    Args:
+        texts (list[str]): Texts to classify.
+        classes (list[str]): List of classes to classify the texts.
+        args (LLMArgs): Language model arguments
+        batch_size (int, optional): Number of texts per prompt. Defaults to 20.
+        concurrency (int, optional): Number of prompts sent at once. Defaults to 4.
+        cache (Cache | None, optional): Cache of labels by text hash.
+        prefilter (bool, optional): Label texts mentioning a class name
+            locally, without calling the model. Defaults to False.
+
+    Returns:
+        list[list[str]]: List of classes of each text.
+
+    Raises:
+        ValueError: If there are no classes.
+    """
+    if not classes:
+        raise ValueError("No classes to classify into")
+    labels: list[list[str] | None] = [None] * len(texts)
+    keys = [Cache.key("classify", args.model, classes, t) for t in texts]
+    pending: list[int] = []
+    for i, text in enumerate(texts):
+        if cache is not None and (cached := cache.get(keys[i])) is not None:
+            labels[i] = cached
+        elif prefilter and (matched := keyword_classify(text, classes)):
+            labels[i] = matched
+        else:
+            pending.append(i)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    # one generation is enough, labels are validated instead of voted
+    batch_args = LLMArgs(**{**args.__dict__, "output_format": "json", "n": 1})
+
+    async def classify_chunk(chunk: list[int]) -> None:
+        async with semaphore:
+            rendered = "\n\n".join(f"ID {j}: {texts[i]}" for j, i in enumerate(chunk))
+            answer: Any = {}
+            try:
+                async for answer in autochain(
+                    messages=prompts.classify_batch.format(
+                        texts=rendered,
+                        classes="\n".join(classes),
+                    ),
+                    **batch_args.__dict__,
+                    schema=prompts.classify_batch_schema(
+                        classes, [str(j) for j in range(len(chunk))]
+                    ),
+                ):
+                    break
+            except parse_errors:
+                # unparsable answer, only the texts of this chunk are reclassified
+                answer = {}
+
+        answer = answer if isinstance(answer, dict) else {}
+        for j, i in enumerate(chunk):
+            if str(j) in answer:
+                labels[i] = validate_labels(answer[str(j)], classes)
+                if cache is not None:
+                    cache.set(keys[i], labels[i])
+
+        # texts skipped by the model are classified on their own
+        await asyncio.gather(
+            *(classify_text(i) for j, i in enumerate(chunk) if str(j) not in answer)
+        )
+
+    async def classify_text(i: int) -> None:
+        async with semaphore:
+            try:
+                labels[i] = await classify(texts[i], classes, args)
+            except parse_errors:
+                # left unlabeled and uncached, so a later run retries it
+                labels[i] = []
+                return
+        if cache is not None:
+            cache.set(keys[i], labels[i])
+
+    await asyncio.gather(
+        *(
+            classify_chunk(pending[k : k + batch_size])
+            for k in range(0, len(pending), batch_size)
+        )
+    )
+    return [label or [] for label in labels]
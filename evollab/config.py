@@ -0,0 +1,37 @@
+from dataclasses import dataclass, field
+
+from openai import AsyncOpenAI
+
+from .budget import Budget
+from .hedging import Hedger
+from .lineage import MethodStore
+from .routing import Router
+from .sampling import Strata
+
+
+@dataclass
+class EvolConfig:
+    """Configuration of evolution tasks and pipelines.
+
+    Each run takes its own config, so several runs with different
+    settings can share one process. Model calls of a run use its client
+    and hedger, see `commands.connected`.
+    """
+
+    total_evol_steps: int = 3
+    early_stop: bool = True
+    total_optm_steps: int = 3
+    development_set_size: int = 10
+    mini_batch_size: int = 5
+    dev_set_reserve_size: int = 10
+    dev_set_growth: int = 5
+    dev_set_strata: Strata = "length"
+    dev_set_classes: list[str] = field(default_factory=list)
+    judge_threshold: float = 0.75
+    task_timeout: float | None = None
+    max_failures: int | None = None
+    router: Router = field(default_factory=Router.default)
+    store: MethodStore | None = None
+    budget: Budget | None = None
+    client: AsyncOpenAI | None = None
+    hedger: Hedger | None = None
@@ -0,0 +1,346 @@
+"""Streaming reader and writer of instruction datasets.
+
+Records are read lazily from JSON lines, CSV or plain text (one record per
+line) files, gzip-compressed or not, so datasets of any size are processed
+in constant memory. JSON arrays are supported too, but loaded whole.
+Outputs are written in chunks to a temporary file which replaces the target
+only once it's complete.
+"""
+
+from __future__ import annotations
+
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import warnings
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Any, Iterable, Iterator, Literal, TypeVar
+
+from .cache import Cache
+
+
+T = TypeVar("T")
+
+Format = Literal["jsonl", "json", "csv", "txt"]
+
+GZIP_MAGIC: bytes = b"\x1f\x8b"
+
+_suffix_formats: dict[str, Format] = {
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+    ".json": "json",
+    ".csv": "csv",
+    ".txt": "txt",
+}
+
+
+@dataclass(slots=True)
+class Record:
+    """Record of a dataset, its text and the rest of its fields."""
+
+    id: str
+    text: str
+    data: dict[str, Any] = field(default_factory=dict)
+
+
+def text_of(item: str | Record) -> str:
+    """Text of a record, or the text itself."""
+    return item.text if isinstance(item, Record) else item
+
+
+def record_id(text: str) -> str:
+    """Stable id of a record without one, derived from its text."""
+    return Cache.key(text)[:16]
+
+
+def detect_format(path: str | Path) -> Format:
+    """Format of a dataset file by its suffix, ignoring `.gz`."""
+    suffixes = [s for s in Path(path).suffixes if s != ".gz"]
+    return _suffix_formats.get(suffixes[-1] if suffixes else "", "txt")
+
+
+def open_text(path: str | Path) -> IO[str]:
+    """Open a dataset file for reading, decompressing gzip transparently.
+
+    Args:
+        path (str | Path): Path of the file, "-" reads the standard input.
+
+    Returns:
+        IO[str]: Text stream of the file.
+    """
+    if str(path) == "-":
+        # closing the stream mustn't close the standard input itself
+        return open(sys.stdin.fileno(), encoding="utf-8", newline="", closefd=False)
+    with open(path, "rb") as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+def select(row: Any, name: str) -> Any:
+    """Select a field of a row, dots select nested fields (e.g. `meta.text`)."""
+    value = row
+    for key in name.split("."):
+        if not isinstance(value, dict) or key not in value:
+            raise KeyError(name)
+        value = value[key]
+    return value
+
+
+def read_records(
+    path: str | Path,
+    format: Format | None = None,
+    field: str = "text",
+    id_field: str | None = None,
+) -> Iterator[Record]:
+    """Stream the records of a dataset file.
+
+    Args:
+        path (str | Path): Path of the file, "-" reads the standard input.
+        format (Format | None, optional): Format of the file, detected
+            from its suffix if not given (plain text by default).
+        field (str, optional): Field holding the text of JSON and CSV
+            records. Defaults to "text".
+        id_field (str | None, optional): Field holding the id of a record,
+            ids are derived from the text if not given.
+
+    Yields:
+        Record: Records with a non-empty text, in order of the file.
+
+    Raises:
+        ValueError: If a record can't be parsed or misses a field.
+    """
+    format = format or (detect_format(path) if str(path) != "-" else "txt")
+    with open_text(path) as f:
+        if format == "txt":
+            rows: Iterable[Any] = ({"text": line.rstrip("\r\n")} for line in f)
+            field, id_field = "text", None
+        elif format == "csv":
+            rows = csv.DictReader(f)
+        elif format == "json":
+            rows = _load_array(f, path)
+        else:
+            rows = (json.loads(line) if line.strip() else None for line in f)
+
+        # records of a JSON array are located by their index, not a line
+        line = 0
+        try:
+            for line, row in enumerate(rows, start=1):
+                if row is None:
+                    continue
+                text = row if isinstance(row, str) else select(row, field)
+                if not isinstance(text, str) or not text.strip():
+                    continue
+                data = row if isinstance(row, dict) else {}
+                key = select(data, id_field) if id_field else None
+                if key is None or key == "":
+                    # e.g. an empty CSV cell, which would give every such row one id
+                    key = record_id(text)
+                yield Record(id=str(key), text=text, data=data)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}:{line + 1}: invalid JSON: {e}") from e
+        except KeyError as e:
+            where = f"[{line - 1}]" if format == "json" else f":{line}"
+            raise ValueError(f"{path}{where}: missing field {e}") from e
+
+
+def _load_array(f: IO[str], path: str | Path) -> list[Any]:
+    # arrays can't be streamed without a parser of their own
+    try:
+        data = json.load(f)
+    except json.JSONDecodeError as e:
+        raise ValueError(
+            f"{path}: invalid JSON: {e} (JSON lines files need a .jsonl suffix)"
+        ) from e
+    if not isinstance(data, list):
+        raise ValueError(f"{path}: expected a JSON array of records")
+    return data
+
+
+def read_texts(
+    path: str | Path,
+    format: Format | None = None,
+    field: str = "text",
+) -> Iterator[str]:
+    """Stream the texts of a dataset file, see `read_records`."""
+    for record in read_records(path, format=format, field=field):
+        yield record.text
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    """Split a stream of items into lists of up to `size` items."""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+class DatasetWriter:
+    """Atomic, chunked writer of a dataset file.
+
+    Rows are written to a temporary file next to the target, in chunks of
+    `chunk_size` rows, which is synced to disk every `fsync_every` chunks
+    and renamed over the target on `close`. Readers never see a partial
+    file, and an aborted write leaves the previous file intact.
+
+    Args:
+        path (str | Path): Path of the file, "-" writes to the standard
+            output directly. A `.gz` suffix compresses the file.
+        format (Format | None, optional): Format of the file, detected
+            from its suffix if not given.
+        chunk_size (int, optional): Rows buffered per write. Defaults to 1000.
+        fsync_every (int, optional): Chunks written per sync. Defaults to 10.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        format: Format | None = None,
+        chunk_size: int = 1000,
+        fsync_every: int = 10,
+    ) -> None:
+        self.stdout = str(path) == "-"
+        self.path = Path(path)
+        self.format: Format = format or (
+            detect_format(path) if not self.stdout else "jsonl"
+        )
+        self.chunk_size = chunk_size
+        self.fsync_every = fsync_every
+        self.rows: list[dict[str, Any] | str] = []
+        self.chunks: int = 0
+        self.written: int = 0
+        self.fieldnames: list[str] | None = None
+        self.dropped_fields: set[str] = set()
+
+        self.tmp_path: Path | None = None
+        self._raw: IO[bytes] | None = None
+        self._gzip: gzip.GzipFile | None = None
+        if self.stdout:
+            self._file: IO[str] = sys.stdout
+            return
+        self.tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        self._raw = open(self.tmp_path, "wb")
+        binary: IO[bytes] = self._raw
+        if self.path.suffix == ".gz":
+            binary = self._gzip = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        self._file = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+
+    def __enter__(self) -> DatasetWriter:
+        return self
+
+    def __exit__(self, exc_type: Any, *_: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, row: dict[str, Any] | str) -> None:
+        """Write a row, a JSON object or a text."""
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered rows, syncing every `fsync_every` chunks."""
+        if not self.rows:
+            return
+        self._file.write(self._render(self.rows))
+        self.written += len(self.rows)
+        self.rows.clear()
+        self.chunks += 1
+        if self.chunks % self.fsync_every == 0:
+            self._sync()
+
+    def close(self) -> None:
+        """Write the remaining rows and replace the target file."""
+        self.flush()
+        if self.format == "json":
+            self._file.write("\n]\n" if self.written else "[]\n")
+        self._file.flush()
+        if self._raw is None:
+            return
+        self._file.detach()
+        if self._gzip is not None:
+            self._gzip.close()  # writes the gzip trailer, keeps the raw file open
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        os.replace(self.tmp_path, self.path)
+        _fsync_dir(self.path.parent)
+
+    def abort(self) -> None:
+        """Discard the written rows, the target file stays untouched."""
+        self.rows.clear()
+        if self._raw is None:
+            return
+        self._file.close()
+        self._raw.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+    def _sync(self) -> None:
+        self._file.flush()
+        if self._raw is not None:
+            self._raw.flush()
+            os.fsync(self._raw.fileno())
+
+    def _render(self, rows: list[dict[str, Any] | str]) -> str:
+        if self.format == "txt":
+            texts = (r if isinstance(r, str) else str(r.get("text", "")) for r in rows)
+            return "".join(t.replace("\n", " ") + "\n" for t in texts)
+
+        objects = [{"text": r} if isinstance(r, str) else r for r in rows]
+        if self.format == "jsonl":
+            return "".join(json.dumps(o, ensure_ascii=False) + "\n" for o in objects)
+        if self.format == "json":
+            # the array is opened by the first chunk and closed by `close`
+            items = ",\n".join(json.dumps(o, ensure_ascii=False) for o in objects)
+            return ("[\n" if not self.written else ",\n") + items
+
+        buffer = io.StringIO()
+        header = self.fieldnames is None
+        if self.fieldnames is None:
+            # fields of the whole first chunk, rows don't all have the same
+            self.fieldnames = list(dict.fromkeys(k for o in objects for k in o))
+        dropped = {k for o in objects for k in o}.difference(
+            self.fieldnames, self.dropped_fields
+        )
+        if dropped:
+            # the header is already written, later fields can't get a column
+            warnings.warn(
+                f"{self.path}: fields {sorted(dropped)} aren't in the CSV header, "
+                "their values are dropped"
+            )
+            self.dropped_fields |= dropped
+        writer = csv.DictWriter(
+            buffer, fieldnames=self.fieldnames, extrasaction="ignore"
+        )
+        if header:
+            writer.writeheader()
+        for o in objects:
+            # nested values don't fit a cell, keep them as JSON
+            writer.writerow(
+                {
+                    k: v if isinstance(v, (str, int, float)) else json.dumps(v)
+                    for k, v in o.items()
+                }
+            )
+        return buffer.getvalue()
+
+
+def _fsync_dir(path: Path) -> None:
+    # make the rename itself durable, not supported on every platform
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
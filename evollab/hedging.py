@@ -0,0 +1,192 @@
+"""Hedged requests for cutting the latency tail of LLM calls.
+
+When a call hasn't returned by the observed latency quantile of its stage,
+a duplicate is fired and whichever finishes first wins. Duplicates are
+limited to a fraction of all calls, so the extra cost stays bounded.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """Sliding window of call latencies per stage."""
+
+    def __init__(self, window: int = 200) -> None:
+        self.window = window
+        self.latencies: dict[str, deque[float]] = {}
+
+    def add(self, key: str, latency: float) -> None:
+        """Record a latency of a call."""
+        self.latencies.setdefault(key, deque(maxlen=self.window)).append(latency)
+
+    def count(self, key: str) -> int:
+        """Number of recorded latencies."""
+        return len(self.latencies.get(key, ()))
+
+    def quantile(self, key: str, q: float) -> float:
+        """Latency quantile of the recorded calls.
+
+        Args:
+            key (str): Stage of the calls.
+            q (float): Quantile between 0 and 1.
+
+        Returns:
+            float: Latency in seconds, infinity if nothing was recorded.
+        """
+        values = sorted(self.latencies.get(key, ()))
+        if not values:
+            return float("inf")
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+
+@dataclass
+class HedgeStats:
+    """Counters of hedged calls."""
+
+    calls: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    saved_seconds: float = 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.calls} calls, {self.hedges} hedged "
+            f"({self.hedges / max(self.calls, 1):.1%} extra), "
+            f"{self.hedge_wins} won by the hedge, "
+            f"{self.saved_seconds:.1f}s of tail latency saved"
+        )
+
+
+class Hedger:
+    """Fires a duplicate of calls slower than the observed latency quantile.
+
+    Args:
+        quantile (float, optional): Latency quantile after which a call
+            is hedged. Defaults to 0.95.
+        budget (float, optional): Maximum ratio of extra calls. Defaults to 0.05.
+        min_samples (int, optional): Latencies recorded for a stage before
+            its calls are hedged. Defaults to 20.
+        window (int, optional): Latencies kept per stage. Defaults to 200.
+    """
+
+    def __init__(
+        self,
+        quantile: float = 0.95,
+        budget: float = 0.05,
+        min_samples: int = 20,
+        window: int = 200,
+    ) -> None:
+        self.quantile = quantile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.tracker = LatencyTracker(window)
+        self.stats: dict[str, HedgeStats] = {}
+        self.losers: set[asyncio.Task] = set()
+
+    def total(self) -> HedgeStats:
+        """Counters summed over all stages."""
+        total = HedgeStats()
+        for stats in self.stats.values():
+            total.calls += stats.calls
+            total.hedges += stats.hedges
+            total.hedge_wins += stats.hedge_wins
+            total.saved_seconds += stats.saved_seconds
+        return total
+
+    def report(self) -> str:
+        """Human readable summary of the hedging per stage."""
+        lines = [f"{key}: {stats}" for key, stats in sorted(self.stats.items())]
+        return "\n".join(lines + [f"total: {self.total()}"])
+
+    def _delay(self, key: str) -> float | None:
+        total = self.total()
+        if self.tracker.count(key) < self.min_samples:
+            return None
+        if total.hedges + 1 > self.budget * max(total.calls, 1):
+            return None
+        return self.tracker.quantile(key, self.quantile)
+
+    async def run(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """Run a call, hedging it if it is slower than usual.
+
+        Args:
+            key (str): Stage of the call, latencies are tracked per stage.
+            call (Callable[[], Awaitable[T]]): Call to run, may be run twice.
+
+        Returns:
+            T: Result of the first call to succeed.
+        """
+        stats = self.stats.setdefault(key, HedgeStats())
+        stats.calls += 1
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(call())
+        hedge: asyncio.Future | None = None
+        try:
+            delay = self._delay(key)
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                self.tracker.add(key, time.perf_counter() - start)
+                return primary.result()
+
+            stats.hedges += 1
+            hedge = asyncio.ensure_future(call())
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                winner = next((t for t in done if t.exception() is None), None)
+                if winner is None and pending:
+                    # first finisher failed, wait for the other one
+                    continue
+                winner = winner or done.pop()
+                finished = time.perf_counter()
+                self.tracker.add(key, finished - start)
+                if winner is hedge:
+                    stats.hedge_wins += 1
+                    for loser in pending:
+                        self._measure_loser(loser, stats, finished)
+                else:
+                    # a hedge slower than its primary saved nothing
+                    for loser in pending:
+                        loser.cancel()
+                return winner.result()
+        except asyncio.CancelledError:
+            # the caller gave up, its calls mustn't run on
+            primary.cancel()
+            if hedge is not None:
+                hedge.cancel()
+            raise
+
+        raise AssertionError("unreachable")
+
+    def _measure_loser(
+        self,
+        loser: asyncio.Future,
+        stats: HedgeStats,
+        finished: float,
+    ) -> None:
+        # the primary is already paid for, let it finish to measure the saving
+        self.losers.add(loser)
+
+        def on_done(task: asyncio.Future) -> None:
+            self.losers.discard(task)
+            if not task.cancelled() and task.exception() is None:
+                stats.saved_seconds += time.perf_counter() - finished
+
+        loser.add_done_callback(on_done)
+
+    async def aclose(self) -> None:
+        """Cancel calls which lost the race and are still running."""
+        for loser in list(self.losers):
+            loser.cancel()
+        await asyncio.gather(*self.losers, return_exceptions=True)
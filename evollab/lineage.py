@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+from .cache import Cache
+from .models import Feedback, Method
+
+
+schema: str = """
+CREATE TABLE IF NOT EXISTS methods (
+    hash TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    parent TEXT REFERENCES methods (hash),
+    feedback TEXT NOT NULL DEFAULT '[]',
+    model TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS methods_parent ON methods (parent);
+
+CREATE TABLE IF NOT EXISTS scores (
+    method TEXT NOT NULL REFERENCES methods (hash),
+    instruction TEXT NOT NULL,
+    model TEXT NOT NULL,
+    failures INTEGER NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (method, instruction, model)
+);
+"""
+
+
+def method_hash(method: Method) -> str:
+    """Hash of a method text, ignoring surrounding whitespace."""
+    return Cache.key(method.data.strip())
+
+
+def instruction_hash(instruction: str) -> str:
+    """Hash of an instruction text."""
+    return Cache.key(instruction)
+
+
+class MethodStore:
+    """Local, indexed store of evolved methods, their lineage and scores.
+
+    Every method is stored with its parent, the feedback it was optimized
+    from and the model which produced it. Scores are the number of failed
+    answers per instruction, so later runs can reuse them and evaluate
+    methods only on instructions they haven't seen yet.
+    """
+
+    def __init__(self, path: str | Path = ":memory:") -> None:
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(schema)
+
+    def close(self) -> None:
+        """Close the underlying database."""
+        self.db.close()
+
+    def add_method(
+        self,
+        method: Method,
+        parent: Method | None = None,
+        feedback: Feedback | None = None,
+        model: str | None = None,
+    ) -> str:
+        """Record a method, lineage missing in an existing record is filled in.
+
+        Args:
+            method (Method): Method to record.
+            parent (Method | None, optional): Method it was optimized from.
+            feedback (Feedback | None, optional): Feedback it was optimized from.
+            model (str | None, optional): Model which produced the method.
+
+        Returns:
+            str: Hash of the method.
+        """
+        key = method_hash(method)
+        parent_key = method_hash(parent) if parent is not None else None
+        if parent_key == key:
+            # an optimization which returned the method unchanged isn't a child
+            parent_key = None
+        with self.db:
+            self.db.execute(
+                "INSERT INTO methods VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (hash) DO UPDATE SET "
+                "parent = COALESCE(parent, excluded.parent), "
+                "feedback = IIF(feedback = '[]', excluded.feedback, feedback), "
+                "model = COALESCE(model, excluded.model)",
+                (
+                    key,
+                    method.data,
+                    parent_key,
+                    json.dumps(list(feedback or [])),
+                    model,
+                    time.time(),
+                ),
+            )
+        return key
+
+    def add_score(
+        self,
+        method: Method,
+        instruction: str,
+        failures: int,
+        model: str,
+    ) -> None:
+        """Record the number of failed answers of a method on an instruction."""
+        self.add_method(method)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)",
+                (
+                    method_hash(method),
+                    instruction_hash(instruction),
+                    model,
+                    failures,
+                    time.time(),
+                ),
+            )
+
+    def score(self, method: Method, instruction: str, model: str) -> int | None:
+        """Recorded number of failed answers, None if not evaluated yet."""
+        row = self.db.execute(
+            "SELECT failures FROM scores "
+            "WHERE method = ? AND instruction = ? AND model = ?",
+            (method_hash(method), instruction_hash(instruction), model),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def top_methods(
+        self,
+        k: int,
+        model: str | None = None,
+        min_scores: int = 1,
+    ) -> list[Method]:
+        """Methods with the smallest mean number of failures.
+
+        Args:
+            k (int): Number of methods to return.
+            model (str | None, optional): Only scores measured with the model.
+            min_scores (int, optional): Minimum number of scored instructions.
+
+        Returns:
+            list[Method]: Best methods, best first.
+        """
+        rows = self.db.execute(
+            "SELECT m.text FROM methods m JOIN scores s ON s.method = m.hash "
+            "WHERE (? IS NULL OR s.model = ?) "
+            "GROUP BY m.hash HAVING COUNT(*) >= ? "
+            "ORDER BY AVG(s.failures), COUNT(*) DESC LIMIT ?",
+            (model, model, min_scores, k),
+        ).fetchall()
+        return [Method(text) for (text,) in rows]
+
+    def lineage(self, method: Method) -> list[Method]:
+        """Ancestors of a method, from its parent to the root.
+
+        Visited hashes are tracked, so a cycle in the stored lineage ends
+        the walk instead of looping forever.
+        """
+        key = method_hash(method)
+        rows = self.db.execute(
+            "WITH RECURSIVE ancestors(hash, depth, visited) AS ("
+            "  SELECT parent, 1, '/' || hash || '/' || parent || '/' FROM methods"
+            "  WHERE hash = ? AND parent IS NOT NULL AND parent != hash"
+            "  UNION ALL"
+            "  SELECT m.parent, a.depth + 1, a.visited || m.parent || '/'"
+            "  FROM methods m JOIN ancestors a ON m.hash = a.hash"
+            "  WHERE m.parent IS NOT NULL"
+            "  AND instr(a.visited, '/' || m.parent || '/') = 0"
+            ") SELECT m.text FROM ancestors a JOIN methods m ON m.hash = a.hash "
+            "ORDER BY a.depth",
+            (key,),
+        ).fetchall()
+        return [Method(text) for (text,) in rows]
+
+    def feedback(self, method: Method) -> Feedback:
+        """Feedback the method was optimized from."""
+        row = self.db.execute(
+            "SELECT feedback FROM methods WHERE hash = ?",
+            (method_hash(method),),
+        ).fetchone()
+        return Feedback(json.loads(row[0]) if row is not None else [])
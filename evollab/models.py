@@ -3,7 +3,17 @@ from __future__ import annotations
 from collections import UserString
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Iterable, Literal, NewType
+from typing import (
+    Any,
+    Generic,
+    Iterable,
+    Iterator,
+    Literal,
+    NewType,
+    Sequence,
+    TypeVar,
+    overload,
+)
 
 from openai.types.chat import ChatCompletionMessageParam
 
@@ -26,25 +36,62 @@ Feedback = NewType("Feedback", list[str])
 """Feedback from the analysis of an evolution trajectory."""
 
 
-@dataclass
+class Evolution(Sequence[str]):
+    """Read-only view over the instruction followed by its evolution steps."""
+
+    __slots__ = ("_trajectory",)
+
+    def __init__(self, trajectory: Trajectory) -> None:
+        self._trajectory = trajectory
+
+    def __len__(self) -> int:
+        return len(self._trajectory.steps) + 1
+
+    @overload
+    def __getitem__(self, index: int) -> str: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[str]: ...
+
+    def __getitem__(self, index: int | slice) -> str | list[str]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("evolution index out of range")
+        if index == 0:
+            return self._trajectory.instruction
+        return self._trajectory.steps[index - 1]
+
+    def __iter__(self) -> Iterator[str]:
+        yield self._trajectory.instruction
+        yield from self._trajectory.steps
+
+    def __repr__(self) -> str:
+        return f"Evolution({list(self)!r})"
+
+
+@dataclass(slots=True)
 class Trajectory:
     """Evolution trajectory of an instruction over a method."""
 
     method: Method
     instruction: str
     steps: list[str] = field(default_factory=list)
+    stop_reason: str | None = None
 
     @property
-    def evolution(self) -> list[str]:
-        """Evolution trajectory of the instruction."""
-        return [self.instruction] + self.steps
+    def evolution(self) -> Evolution:
+        """Evolution trajectory of the instruction (without copying steps)."""
+        return Evolution(self)
 
     def add(self, step: str) -> None:
         """Add a step to the evolution trajectory."""
         self.steps.append(step)
 
 
-@dataclass
+@dataclass(slots=True)
 class EvolReport:
     """Evolution report of an instruction."""
 
@@ -52,6 +99,35 @@ class EvolReport:
     feedback: Feedback
 
 
+@dataclass(slots=True)
+class BacktranslationPair:
+    """Instruction and response derived from a source passage."""
+
+    passage: str
+    instruction: str
+    response: str
+    overlap: float
+    judgement: float | None = None
+    verified: bool = False
+    id: str | None = None
+
+
+T = TypeVar("T")
+
+
+@dataclass(slots=True)
+class Outcome(Generic[T]):
+    """Result of a single task, or the error it failed with."""
+
+    result: T | None = None
+    error: BaseException | None = None
+
+    @property
+    def ok(self) -> bool:
+        """Whether the task finished without an error."""
+        return self.error is None
+
+
 default_template_system_prompt: str = (
     "You are a helpful assistant. "
     "Current date is {current_date} "
@@ -82,6 +158,41 @@ class Template:
 
 OutputFormat = Literal["json", "text"]
 
+StructuredOutput = Literal["json_schema", "tools", "off"]
+"""How a structured output is requested from the provider."""
+
+
+def object_schema(**properties: Any) -> dict[str, Any]:
+    """Strict JSON schema of an object with all properties required."""
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+@dataclass(frozen=True)
+class Schema:
+    """Named JSON schema of a structured model output."""
+
+    name: str
+    schema: dict[str, Any]
+
+    def response_format(self) -> dict[str, Any]:
+        """Schema as a JSON-schema `response_format` argument."""
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": self.name, "schema": self.schema, "strict": True},
+        }
+
+    def tool(self) -> dict[str, Any]:
+        """Schema as the parameters of a function tool."""
+        return {
+            "type": "function",
+            "function": {"name": self.name, "parameters": self.schema, "strict": True},
+        }
+
 
 @dataclass
 class LLMArgs:
@@ -91,6 +202,7 @@ class LLMArgs:
     top_p: float = 0.95
     seed: int = 47
     n: int = 1
+    structured_output: StructuredOutput = "json_schema"
 
     @classmethod
     def default(cls) -> "LLMArgs":
@@ -0,0 +1,231 @@
+"""Composable streaming pipelines over evollab commands.
+
+Each stage is an async stream transformer with its own concurrency;
+stages are connected by bounded queues, so a slow stage applies
+backpressure to the ones before it instead of buffering everything:
+
+    pipeline = augment() | derive() | evolve(steps=2) | answer() | keep(valid)
+    async for instruction, response in pipeline.run(texts, config):
+        ...
+
+Dataset records (see `evollab.datasets`) stream through just as well: their
+text goes through the stages and each output is yielded with its record.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import inspect
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable
+
+import click
+
+from . import commands
+from .config import EvolConfig
+from .datasets import Record
+from .models import Method
+
+
+StageFunc = Callable[[Any, EvolConfig], Awaitable[Any]]
+
+_end = object()
+_skip = object()
+
+
+class Stage:
+    """Single step of a pipeline, transforming each item of a stream."""
+
+    def __init__(
+        self,
+        func: StageFunc,
+        concurrency: int = 4,
+        name: str | None = None,
+    ) -> None:
+        self.func = func
+        self.concurrency = concurrency
+        self.name = name or func.__name__
+
+    def __or__(self, other: Stage | Pipeline) -> Pipeline:
+        return Pipeline([self]) | other
+
+    def __repr__(self) -> str:
+        return f"Stage({self.name}, concurrency={self.concurrency})"
+
+
+class Pipeline:
+    """Sequence of stages connected by bounded queues.
+
+    Items are processed concurrently, so their order isn't preserved.
+    Items failing in a stage are reported and dropped.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 16) -> None:
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def __or__(self, other: Stage | Pipeline) -> Pipeline:
+        stages = other.stages if isinstance(other, Pipeline) else [other]
+        return Pipeline(self.stages + stages, self.queue_size)
+
+    def __repr__(self) -> str:
+        return " | ".join(stage.name for stage in self.stages)
+
+    async def run(
+        self,
+        items: Iterable[Any] | AsyncIterable[Any],
+        config: EvolConfig | None = None,
+    ) -> AsyncIterator[Any]:
+        """Stream items through the pipeline.
+
+        Args:
+            items (Iterable[Any] | AsyncIterable[Any]): Input items or
+                dataset records, pulled lazily as the first stage has room
+                for them.
+            config (EvolConfig | None, optional): Configuration of this run.
+
+        Yields:
+            Any: Outputs of the last stage, a `(record, output)` pair for
+                an input record, since outputs come out of order.
+
+        Raises:
+            Exception: Error of the input stream, once the items read before
+                it went through the pipeline.
+        """
+        config = config or EvolConfig()
+        queues: list[asyncio.Queue] = [
+            asyncio.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)
+        ]
+
+        # items are queued with the record they come from, if any
+        def source(item: Any) -> tuple[Record | None, Any]:
+            return (item, item.text) if isinstance(item, Record) else (None, item)
+
+        async def produce() -> None:
+            try:
+                if isinstance(items, AsyncIterable):
+                    async for item in items:
+                        await queues[0].put(source(item))
+                else:
+                    for item in items:
+                        await queues[0].put(source(item))
+            except Exception:
+                # end the stream anyway, the error is raised once it's drained
+                await queues[0].put(_end)
+                raise
+            await queues[0].put(_end)
+
+        async def work(stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue):
+            while (item := await inbox.get()) is not _end:
+                record, value = item
+                try:
+                    result = await stage.func(value, config)
+                except Exception as e:
+                    click.echo(f"{stage.name} failed: {e!r}")
+                    continue
+                if result is not _skip:
+                    await outbox.put((record, result))
+            # let the sibling workers see the end too
+            await inbox.put(_end)
+
+        async def supervise(stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue):
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    for _ in range(stage.concurrency):
+                        tg.create_task(work(stage, inbox, outbox))
+            except Exception:
+                await outbox.put(_end)
+                raise
+            await outbox.put(_end)
+
+        # runners inherit the client and hedger of the run
+        with commands.connected(config.client, config.hedger):
+            runners = [asyncio.create_task(produce())] + [
+                asyncio.create_task(supervise(stage, queues[i], queues[i + 1]))
+                for i, stage in enumerate(self.stages)
+            ]
+        try:
+            while (item := await queues[-1].get()) is not _end:
+                record, result = item
+                yield result if record is None else (record, result)
+            await asyncio.gather(*runners)
+        finally:
+            for runner in runners:
+                runner.cancel()
+
+
+def stage(concurrency: int = 4, name: str | None = None):
+    """Turn an async function of an item and a config into a stage factory."""
+
+    def decorator(func: StageFunc) -> Callable[..., Stage]:
+        def factory(concurrency: int = concurrency) -> Stage:
+            return Stage(func, concurrency=concurrency, name=name or func.__name__)
+
+        return factory
+
+    return decorator
+
+
+def transform(func: Callable[[Any], Any], concurrency: int = 4) -> Stage:
+    """Stage applying a sync or async function to each item."""
+
+    async def apply(item: Any, config: EvolConfig) -> Any:
+        result = func(item)
+        return await result if inspect.isawaitable(result) else result
+
+    name = getattr(func, "__name__", "transform")
+    return Stage(apply, concurrency=concurrency, name=name)
+
+
+def keep(predicate: Callable[[Any], bool], concurrency: int = 1) -> Stage:
+    """Stage keeping only items the predicate accepts."""
+
+    async def apply(item: Any, config: EvolConfig) -> Any:
+        return item if predicate(item) else _skip
+
+    return Stage(apply, concurrency=concurrency, name="keep")
+
+
+@stage()
+async def augment(text: str, config: EvolConfig) -> str:
+    """Augment a text."""
+    return await config.router.run(
+        "augment",
+        lambda args: commands.augment(text, args),
+    )
+
+
+@stage()
+async def derive(text: str, config: EvolConfig) -> str:
+    """Derive an instruction from a text."""
+    return await config.router.run(
+        "derive",
+        lambda args: commands.derive(text, args),
+    )
+
+
+def evolve(
+    steps: int = 1,
+    method: Method | None = None,
+    concurrency: int = 4,
+) -> Stage:
+    """Stage evolving an instruction, yielding its last evolution."""
+
+    async def apply(instruction: str, config: EvolConfig) -> str:
+        kwargs = {"method": method} if method is not None else {}
+        trajectory = await config.router.run(
+            "evolve",
+            lambda args: commands.evolve(instruction, steps=steps, args=args, **kwargs),
+        )
+        return trajectory.evolution[-1]
+
+    return Stage(apply, concurrency=concurrency, name="evolve")
+
+
+@stage()
+async def answer(instruction: str, config: EvolConfig) -> tuple[str, str]:
+    """Answer an instruction, yielding the instruction and its answer."""
+    response = await config.router.run(
+        "answer",
+        lambda args: commands.answer(instruction, args),
+    )
+    return instruction, response
@@ -0,0 +1,266 @@
+"""Cost estimation and budget fitting of method evolution runs.
+
+Token counts come from the rendered prompts of the run, counted locally,
+while completion lengths and latencies are rough per-stage assumptions.
+Estimates are upper bounds: early stopped evolutions and coalesced calls
+only make a run cheaper.
+"""
+
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass, replace
+from statistics import fmean
+from typing import Any, Iterable, Sequence
+
+from . import prompts
+from .budget import Budget
+from .config import EvolConfig
+from .models import Method
+from .tokens import count_tokens
+
+
+answer_tokens: int = 400
+"""Assumed completion tokens of an answer."""
+
+step_tokens: int = 30
+"""Assumed tokens an evolution step adds to an instruction."""
+
+constraint_tokens: int = 40
+"""Assumed tokens of the analysis of a single instruction."""
+
+call_latency: float = 1.0
+"""Assumed seconds of a call before its first completion token."""
+
+tokens_per_second: float = 60.0
+"""Assumed completion tokens generated per second."""
+
+
+class EmptyDevSet(ValueError):
+    """Raised when a run has no development instructions to plan for."""
+
+
+class BudgetTooSmall(ValueError):
+    """Raised when even the smallest run doesn't fit the budget."""
+
+
+@dataclass(slots=True)
+class Estimate:
+    """Estimated cost of a run."""
+
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def fits(self, budget: Budget) -> bool:
+        """Check whether the run fits the budget."""
+        return budget.allows(self.calls, self.tokens, self.seconds)
+
+    def __str__(self) -> str:
+        return (
+            f"{self.calls} calls, {self.prompt_tokens} prompt + "
+            f"{self.completion_tokens} completion tokens, ~{self.seconds:.0f}s"
+        )
+
+
+@dataclass(slots=True)
+class Call:
+    """Estimated tokens of a single call."""
+
+    prompt_tokens: float
+    completion_tokens: float
+
+    @property
+    def seconds(self) -> float:
+        return call_latency + self.completion_tokens / tokens_per_second
+
+
+@dataclass(slots=True)
+class StageCosts:
+    """Token counts of the prompts of a run, measured on its instructions."""
+
+    instruction_tokens: float
+    method_tokens: float
+    evolve_tokens: float
+    analyze_tokens: float
+    optimize_tokens: float
+    answer_n: int = 1
+
+    def evolve(self, depth: int) -> Call:
+        """Evolution of an instruction already evolved `depth` times."""
+        return Call(
+            self.evolve_tokens + depth * step_tokens,
+            self.instruction_tokens + (depth + 1) * step_tokens,
+        )
+
+    def analyze(self, steps: int) -> Call:
+        stages = sum(
+            self.instruction_tokens + k * step_tokens for k in range(steps + 1)
+        )
+        return Call(self.analyze_tokens + stages, constraint_tokens)
+
+    def optimize(self, batch_size: int) -> Call:
+        return Call(
+            self.optimize_tokens + batch_size * constraint_tokens,
+            self.method_tokens,
+        )
+
+    def answer(self, depth: int) -> Call:
+        return Call(
+            self.instruction_tokens + depth * step_tokens,
+            answer_tokens * self.answer_n,
+        )
+
+
+def measure_costs(
+    instructions: Sequence[str],
+    config: EvolConfig,
+    method: Method = Method(prompts.initial_method),
+) -> StageCosts:
+    """Count tokens of the prompts of a run on its instructions.
+
+    Args:
+        instructions (Sequence[str]): Instructions of the run (e.g. its
+            development set), a sample is enough.
+        config (EvolConfig): Configuration of the run.
+        method (Method, optional): Method the run starts from.
+
+    Returns:
+        StageCosts: Average token counts of the prompts.
+    """
+
+    def tokens(messages: Iterable[Any], stage: str) -> int:
+        model = config.router.args(stage).model
+        return sum(count_tokens(m["content"], model) for m in messages)
+
+    sample = list(instructions) or [""]
+    return StageCosts(
+        instruction_tokens=fmean(
+            count_tokens(i, config.router.args("evolve").model) for i in sample
+        ),
+        method_tokens=count_tokens(method.data, config.router.args("optimize").model),
+        evolve_tokens=fmean(
+            tokens(prompts.evolve.format(instruction=i, method=method.data), "evolve")
+            for i in sample
+        ),
+        analyze_tokens=tokens(prompts.analyze.format(trajectory=""), "analyze"),
+        optimize_tokens=tokens(
+            prompts.optimize.format(method=method.data, feedback=""), "optimize"
+        ),
+        answer_n=config.router.args("answer").n,
+    )
+
+
+def estimate_run(
+    config: EvolConfig,
+    costs: StageCosts,
+    start_methods: int = 1,
+) -> Estimate:
+    """Estimate the cost of evolving a method with the configuration.
+
+    Mini batches are evolved concurrently, and so are the evaluations of
+    the candidate methods, so the wall time follows the longest batch and
+    the evaluation of a single method. Growth of the development set on
+    ties isn't included, it's stopped by the budget meter instead.
+
+    Args:
+        config (EvolConfig): Configuration of the run.
+        costs (StageCosts): Token counts of the prompts of the run.
+        start_methods (int, optional): Number of methods the run starts from.
+
+    Returns:
+        Estimate: Estimated cost of the run.
+    """
+    size, steps = config.development_set_size, config.total_evol_steps
+    batch_size = min(config.mini_batch_size, size)
+    num_batches = math.ceil(size / config.mini_batch_size)
+    candidates = start_methods + num_batches * config.total_optm_steps
+    estimate = Estimate()
+
+    def add(call: Call, count: int) -> None:
+        estimate.calls += count
+        estimate.prompt_tokens += math.ceil(call.prompt_tokens * count)
+        estimate.completion_tokens += math.ceil(call.completion_tokens * count)
+
+    # evolution and analysis of every instruction, optimization per batch
+    for depth in range(steps):
+        add(costs.evolve(depth), size)
+    add(costs.analyze(steps), size)
+    add(costs.optimize(batch_size), num_batches * config.total_optm_steps)
+    batch_seconds = (
+        batch_size * sum(costs.evolve(d).seconds for d in range(steps))
+        + batch_size * costs.analyze(steps).seconds
+        + config.total_optm_steps * costs.optimize(batch_size).seconds
+    )
+
+    # every candidate evolves each instruction once and answers both stages
+    add(costs.evolve(0), candidates * size)
+    add(costs.answer(0), candidates * size)
+    add(costs.answer(1), candidates * size)
+    evaluation_seconds = size * (
+        costs.evolve(0).seconds + costs.answer(0).seconds + costs.answer(1).seconds
+    )
+
+    estimate.seconds = batch_seconds + evaluation_seconds
+    return estimate
+
+
+def fit_config(
+    config: EvolConfig,
+    budget: Budget,
+    costs: StageCosts,
+    start_methods: int = 1,
+) -> tuple[EvolConfig, Estimate]:
+    """Fit evolution steps, candidates and development set size to a budget.
+
+    The configured values are upper bounds; the fitted configuration
+    keeps as much of the work (size x steps x candidates) as fits the
+    budget, preferring the cheaper one on ties.
+
+    Args:
+        config (EvolConfig): Configuration of the run.
+        budget (Budget): Budget of the run.
+        costs (StageCosts): Token counts of the prompts of the run.
+        start_methods (int, optional): Number of methods the run starts from.
+
+    Returns:
+        tuple[EvolConfig, Estimate]: Fitted configuration and its estimate.
+
+    Raises:
+        EmptyDevSet: If the development set is empty.
+        BudgetTooSmall: If even the smallest run doesn't fit the budget.
+    """
+    if config.development_set_size < 1:
+        raise EmptyDevSet("The development set is empty, there's nothing to plan")
+
+    best: tuple[tuple[int, int], EvolConfig, Estimate] | None = None
+    for size in range(1, config.development_set_size + 1):
+        for steps in range(1, config.total_evol_steps + 1):
+            for optm_steps in range(1, config.total_optm_steps + 1):
+                fitted = replace(
+                    config,
+                    development_set_size=size,
+                    total_evol_steps=steps,
+                    total_optm_steps=optm_steps,
+                )
+                estimate = estimate_run(fitted, costs, start_methods)
+                if not estimate.fits(budget):
+                    continue
+                rank = (size * steps * optm_steps, -estimate.tokens)
+                if best is None or rank > best[0]:
+                    best = (rank, fitted, estimate)
+
+    if best is None:
+        smallest = replace(
+            config, development_set_size=1, total_evol_steps=1, total_optm_steps=1
+        )
+        raise BudgetTooSmall(
+            "Budget too small, the smallest run needs "
+            f"{estimate_run(smallest, costs, start_methods)}"
+        )
+    return best[1], best[2]
@@ -4,4 +4,5 @@ from .classify import *
 from .derive import *
 from .evolve import *
 from .introspect import *
+from .judge import *
 from .optimize import *
@@ -1,4 +1,4 @@
-from ..models import Template
+from ..models import Schema, Template, object_schema
 
 
 analyze_user = """
@@ -44,3 +44,17 @@ analyze = Template(
     system=analyze_system,
     user=analyze_user,
 )
+
+analyze_schema = Schema(
+    name="analysis",
+    schema=object_schema(
+        cases={
+            "type": "array",
+            "items": object_schema(
+                case_id={"type": "string"},
+                reason={"type": "string"},
+                constraint={"type": "string"},
+            ),
+        },
+    ),
+)
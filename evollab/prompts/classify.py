@@ -1,4 +1,4 @@
-from ..models import Template
+from ..models import Schema, Template, object_schema
 
 
 classify_user = """
@@ -31,3 +31,44 @@ classify = Template(
     system=classify_system,
     user=classify_user,
 )
+
+
+classify_batch_user = """
+You are Text Classifier that assigns each of the given #Texts# to one or more of the following classes:
+{classes}
+
+Use only the classes listed above, with the exact same spelling.
+If no class fits a text, assign it an empty list.
+
+Reply strictly with a JSON object mapping the ID of every text to the list of its classes,
+without any explanation:
+```json
+{{
+    "<ID>": ["<Class>", ...],
+    // repeat for other texts
+}}
+```
+
+#Texts#:
+{texts}
+"""
+
+classify_batch = Template(
+    system=classify_system,
+    user=classify_batch_user,
+)
+
+
+def classify_schema(classes: list[str]) -> Schema:
+    """Schema of the classes of a single text."""
+    labels = {"type": "array", "items": {"type": "string", "enum": classes}}
+    return Schema(name="classes", schema=object_schema(classes=labels))
+
+
+def classify_batch_schema(classes: list[str], ids: list[str]) -> Schema:
+    """Schema of the classes of every text of a batch, by text ID."""
+    labels = {"type": "array", "items": {"type": "string", "enum": classes}}
+    return Schema(
+        name="classes_by_id",
+        schema=object_schema(**{i: labels for i in ids}),
+    )
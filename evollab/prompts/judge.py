@@ -0,0 +1,52 @@
+from ..models import Schema, Template, object_schema
+
+
+judge_user = """
+You are a Response Judge that checks whether the #Response# to the #Instruction# 
+is consistent with the #Passage# the instruction was derived from.
+
+Please follow the steps below to judge the #Response#.
+
+Step 1: Please read the "#Passage#" carefully and list the facts relevant to the #Instruction#.
+
+Step 2: Please compare the #Response# with the facts, and identify missing, contradicting 
+or made up information.
+
+Step 3: Please rate the agreement of the #Response# with the #Passage# on a scale from 1 
+(contradicts or ignores the passage) to 5 (fully consistent and complete).
+
+Reply strictly with the following JSON, without any explanation:
+```json
+{{
+    "reason": "<Reason>",
+    "score": <Score>
+}}
+```
+
+#Passage#:
+{passage}
+
+#Instruction#:
+{instruction}
+
+#Response#:
+{response}
+"""
+
+judge_system = (
+    "You are a Response Judge. "
+    "Your strict and unbiased judgement is crucial for the quality of the dataset."
+)
+
+judge = Template(
+    system=judge_system,
+    user=judge_user,
+)
+
+judge_schema = Schema(
+    name="judgement",
+    schema=object_schema(
+        reason={"type": "string"},
+        score={"type": "integer", "enum": [1, 2, 3, 4, 5]},
+    ),
+)
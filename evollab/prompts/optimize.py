@@ -1,4 +1,4 @@
-from ..models import Template
+from ..models import Schema, Template, object_schema
 
 
 optimize_user = """
@@ -39,3 +39,8 @@ optimize = Template(
     system=optimize_system,
     user=optimize_user,
 )
+
+optimize_schema = Schema(
+    name="updated_template",
+    schema=object_schema(template={"type": "string"}),
+)
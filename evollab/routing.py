@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import json
+import tomllib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterator, Literal, TypeVar
+
+import click
+
+from .models import LLMArgs
+
+
+T = TypeVar("T")
+
+Stage = Literal[
+    "evolve",
+    "analyze",
+    "optimize",
+    "answer",
+    "judge",
+    "augment",
+    "derive",
+    "classify",
+]
+
+current_stage: ContextVar[str] = ContextVar("current_stage", default="default")
+"""Pipeline stage of the running call, set by `Router.run`."""
+
+parse_errors: tuple[type[Exception], ...] = (ValueError, KeyError, TypeError)
+"""Errors treated as unparsable output, escalating to the next model."""
+
+
+@contextmanager
+def in_stage(stage: Stage) -> Iterator[None]:
+    """Attribute the calls of the enclosed block to a pipeline stage."""
+    token = current_stage.set(stage)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+
+@dataclass
+class Router:
+    """Routing of pipeline stages to models and their sampling arguments.
+
+    Each stage maps to a cascade of `LLMArgs`, ordered from the cheapest
+    to the strongest model. Stages without a route use the fallback args.
+    """
+
+    routes: dict[str, list[LLMArgs]] = field(default_factory=dict)
+    fallback: LLMArgs = field(default_factory=LLMArgs.default)
+
+    def cascade(self, stage: Stage) -> list[LLMArgs]:
+        """Models to try for a stage, cheapest first."""
+        return self.routes.get(stage) or [self.fallback]
+
+    def args(self, stage: Stage) -> LLMArgs:
+        """Arguments of the first (cheapest) model of a stage."""
+        return self.cascade(stage)[0]
+
+    async def run(
+        self,
+        stage: Stage,
+        call: Callable[[LLMArgs], Awaitable[T]],
+        validate: Callable[[T], bool] | None = None,
+    ) -> T:
+        """Run a call over the stage cascade until its output is accepted.
+
+        The next model is tried only when the output can't be parsed
+        (the call raises one of `parse_errors`) or the validator rejects it.
+
+        Args:
+            stage (Stage): Pipeline stage of the call.
+            call (Callable[[LLMArgs], Awaitable[T]]): Call to run with the args.
+            validate (Callable[[T], bool] | None, optional): Output validator.
+
+        Returns:
+            T: First accepted output.
+
+        Raises:
+            ValueError: If no model of the cascade produced an accepted output.
+        """
+        cascade = self.cascade(stage)
+        error: Exception | None = None
+        with in_stage(stage):
+            for i, args in enumerate(cascade):
+                try:
+                    result = await call(args)
+                except parse_errors as e:
+                    error = e
+                else:
+                    if validate is None or validate(result):
+                        return result
+                    error = ValueError(f"{stage} output rejected by validator")
+
+                if i + 1 < len(cascade):
+                    click.echo(f"{stage} failed on {args.model}, escalating: {error!r}")
+
+        raise ValueError(f"All {stage} models failed") from error
+
+    @classmethod
+    def default(cls, fallback: LLMArgs | None = None) -> Router:
+        """Default routing, analysis and optimization use a stronger model."""
+        fallback = fallback or LLMArgs.default()
+        strong = LLMArgs(
+            model="anthropic/claude-3.5-sonnet",
+            temperature=0.6,
+            structured_output=fallback.structured_output,
+        )
+        return cls(
+            routes={
+                "analyze": [replace(strong, output_format="json")],
+                "optimize": [strong],
+            },
+            fallback=fallback,
+        )
+
+    @classmethod
+    def load(cls, path: str | Path, fallback: LLMArgs | None = None) -> Router:
+        """Load routing from a TOML or JSON file.
+
+        The file maps stages to a single model or to a cascade of models,
+        e.g. in TOML:
+
+            [default]
+            model = "openai/gpt-4o-mini"
+
+            [[stages.analyze]]
+            model = "openai/gpt-4o-mini"
+            output_format = "json"
+
+            [[stages.analyze]]
+            model = "anthropic/claude-3.5-sonnet"
+            output_format = "json"
+
+        Stages missing in the file keep their default routes.
+
+        Args:
+            path (str | Path): Path of the routing file.
+            fallback (LLMArgs | None, optional): Args of stages without a route.
+
+        Returns:
+            Router: Loaded router.
+        """
+        path = Path(path)
+        text = path.read_text()
+        config: dict[str, Any] = (
+            json.loads(text) if path.suffix == ".json" else tomllib.loads(text)
+        )
+
+        router = cls.default(fallback)
+        if "default" in config:
+            router.fallback = LLMArgs(**config["default"])
+        for stage, cascade in config.get("stages", {}).items():
+            if isinstance(cascade, dict):
+                cascade = [cascade]
+            router.routes[stage] = [LLMArgs(**args) for args in cascade]
+        return router
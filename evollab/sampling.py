@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import json
+import math
+import random
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable, Literal, TypeVar
+
+from . import commands
+from .models import LLMArgs
+
+
+T = TypeVar("T")
+
+Strata = Literal["none", "length", "category"]
+
+length_strata_bounds: tuple[int, ...] = (12, 32, 96)
+"""Upper bounds (in words) of the length strata, the last stratum is open."""
+
+
+@dataclass
+class DevSet:
+    """Development set of instructions used to rank evolution methods."""
+
+    instructions: list[str]
+    reserve: list[str] = field(default_factory=list)
+    seed: int | None = None
+    strata: Strata = "none"
+
+    def grow(self, k: int) -> list[str]:
+        """Move up to `k` instructions from the reserve to the development set.
+
+        Args:
+            k (int): Number of instructions to add.
+
+        Returns:
+            list[str]: Added instructions.
+        """
+        extra, self.reserve = self.reserve[:k], self.reserve[k:]
+        self.instructions.extend(extra)
+        return extra
+
+    def save(self, path: str | Path) -> None:
+        """Save the development set as JSON."""
+        Path(path).write_text(json.dumps(asdict(self), indent=2))
+
+    @classmethod
+    def load(cls, path: str | Path) -> DevSet:
+        """Load a development set saved with `save`."""
+        return cls(**json.loads(Path(path).read_text()))
+
+
+def reservoir_sample(items: Iterable[T], k: int, rng: random.Random) -> list[T]:
+    """Sample up to `k` items uniformly in a single pass over the items.
+
+    Args:
+        items (Iterable[T]): Items to sample from, may be a lazy stream.
+        k (int): Number of items to sample.
+        rng (random.Random): Source of randomness.
+
+    Returns:
+        list[T]: Sampled items, all items if there are fewer than `k`.
+    """
+    reservoir: list[T] = []
+    for i, item in enumerate(items):
+        if i < k:
+            reservoir.append(item)
+        elif (j := rng.randrange(i + 1)) < k:
+            reservoir[j] = item
+    rng.shuffle(reservoir)
+    return reservoir
+
+
+def length_stratum(text: str) -> str:
+    """Assign a text to a stratum based on its length in words."""
+    words = len(text.split())
+    for bound in length_strata_bounds:
+        if words <= bound:
+            return f"<={bound}"
+    return f">{length_strata_bounds[-1]}"
+
+
+def stratified_order(
+    items: list[T],
+    key: Callable[[T], str],
+    rng: random.Random,
+) -> list[T]:
+    """Order items so that every prefix is stratified proportionally.
+
+    Args:
+        items (list[T]): Items to order.
+        key (Callable[[T], str]): Function assigning an item to its stratum.
+        rng (random.Random): Source of randomness.
+
+    Returns:
+        list[T]: Reordered items.
+    """
+    strata: dict[str, list[T]] = {}
+    for item in items:
+        strata.setdefault(key(item), []).append(item)
+    for stratum in strata.values():
+        rng.shuffle(stratum)
+
+    taken: dict[str, int] = dict.fromkeys(strata, 0)
+    ordered: list[T] = []
+    while len(ordered) < len(items):
+        # next item comes from the least represented stratum so far
+        name = min(
+            (s for s in strata if taken[s] < len(strata[s])),
+            key=lambda s: (taken[s] + 1) / len(strata[s]),
+        )
+        ordered.append(strata[name][taken[name]])
+        taken[name] += 1
+    return ordered
+
+
+async def build_dev_set(
+    instructions: Iterable[str],
+    size: int,
+    reserve_size: int = 0,
+    seed: int | None = None,
+    strata: Strata = "length",
+    classes: list[str] | None = None,
+    args: LLMArgs = LLMArgs.default(),
+    oversample: int = 4,
+) -> DevSet:
+    """Build a development set from a stream of instructions.
+
+    The instructions are reservoir sampled in a single pass, so the input
+    may be an arbitrarily large iterator. With stratification, a larger
+    pool is sampled first and then ordered so that both the development
+    set and its reserve keep the proportions of the strata.
+
+    Args:
+        instructions (Iterable[str]): Instructions to sample from.
+        size (int): Number of instructions in the development set.
+        reserve_size (int, optional): Number of extra instructions kept
+            aside for growing the set later. Defaults to 0.
+        seed (int | None, optional): Seed of the sampling. Defaults to None.
+        strata (Strata, optional): Stratify by `length`, by `category`
+            (using `commands.classify_batch`) or not at all. Defaults to "length".
+        classes (list[str] | None, optional): Classes for `category` strata.
+        args (LLMArgs, optional): Language model arguments for classification.
+        oversample (int, optional): Pool size multiplier for stratification.
+
+    Returns:
+        DevSet: Development set with its reserve.
+
+    Raises:
+        ValueError: If `category` strata are requested without classes.
+    """
+    if strata == "category" and not classes:
+        raise ValueError("Category strata require a list of classes.")
+
+    rng = random.Random(seed)
+    total = size + reserve_size
+    pool = reservoir_sample(
+        instructions,
+        k=total if strata == "none" else total * oversample,
+        rng=rng,
+    )
+
+    if strata == "length":
+        pool = stratified_order(pool, length_stratum, rng)
+    elif strata == "category":
+        assert classes is not None
+        labels = await commands.classify_batch(pool, classes, args)
+        categories = {
+            instr: label[0] if label else "other" for instr, label in zip(pool, labels)
+        }
+        pool = stratified_order(pool, categories.__getitem__, rng)
+
+    return DevSet(
+        instructions=pool[:size],
+        reserve=pool[size:total],
+        seed=seed,
+        strata=strata,
+    )
+
+
+def are_tied(a: float, b: float, n: int, z: float = 1.96) -> bool:
+    """Check whether two error rates are statistically indistinguishable.
+
+    Uses a two-proportion z-test with pooled variance, both errors being
+    measured over `n` instructions.
+
+    Args:
+        a (float): First error rate.
+        b (float): Second error rate.
+        n (int): Number of instructions each error was measured over.
+        z (float, optional): Critical value. Defaults to 1.96 (95%).
+
+    Returns:
+        bool: True if the difference isn't significant.
+    """
+    if n <= 0:
+        return True
+    p = min(max((a + b) / 2, 0.0), 1.0)
+    std_err = math.sqrt(max(p * (1 - p), 1 / n) * 2 / n)
+    return abs(a - b) <= z * std_err
@@ -0,0 +1,296 @@
+"""Long-lived local HTTP server exposing evollab commands.
+
+All requests share one LLM client, one scheduler limiting concurrent
+upstream work, and one response cache. Identical requests in flight at
+the same time are coalesced into a single upstream call.
+
+    POST /<command>   {"text": "...", ...}           -> {"result": ...}
+    POST /batch       {"requests": [{"command": "...", ...}, ...]}
+    GET  /metrics     queue depth, cache and latency statistics
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable
+
+import click
+
+from . import commands
+from .cache import Cache, SingleFlight
+from .config import EvolConfig
+from .hedging import LatencyTracker
+from .models import Method
+
+
+Handler = Callable[[dict[str, Any], EvolConfig], Awaitable[Any]]
+
+_missing = object()
+
+
+def _field(
+    payload: dict[str, Any], name: str, kind: type, default: Any = _missing
+) -> Any:
+    # argument of a command, checked before any upstream call so bad requests
+    # get a 400 instead of failing later as a 502
+    value = payload.get(name, default)
+    if value is _missing:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Missing field: {name!r}")
+    if name not in payload:
+        return value
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise HTTPError(
+            HTTPStatus.BAD_REQUEST, f"Expected {name!r} to be {kind.__name__}"
+        )
+    return value
+
+
+async def _augment(payload: dict[str, Any], config: EvolConfig) -> Any:
+    text = _field(payload, "text", str)
+    return await config.router.run("augment", lambda args: commands.augment(text, args))
+
+
+async def _derive(payload: dict[str, Any], config: EvolConfig) -> Any:
+    text = _field(payload, "text", str)
+    return await config.router.run("derive", lambda args: commands.derive(text, args))
+
+
+async def _answer(payload: dict[str, Any], config: EvolConfig) -> Any:
+    text = _field(payload, "text", str)
+    return await config.router.run("answer", lambda args: commands.answer(text, args))
+
+
+async def _classify(payload: dict[str, Any], config: EvolConfig) -> Any:
+    text, classes = _field(payload, "text", str), _field(payload, "classes", list)
+    if not classes or not all(isinstance(c, str) for c in classes):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected at least one class name")
+    return await config.router.run(
+        "classify",
+        lambda args: commands.classify(text, classes, args),
+    )
+
+
+async def _evolve(payload: dict[str, Any], config: EvolConfig) -> Any:
+    text, steps = _field(payload, "text", str), _field(payload, "steps", int, 1)
+    if steps < 1:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected at least one step")
+    method = _field(payload, "method", str, None)
+    kwargs = {"method": Method(method)} if method is not None else {}
+    trajectory = await config.router.run(
+        "evolve",
+        lambda args: commands.evolve(text, steps=steps, args=args, **kwargs),
+    )
+    return list(trajectory.evolution)
+
+
+async def _judge(payload: dict[str, Any], config: EvolConfig) -> Any:
+    passage = _field(payload, "passage", str)
+    instruction = _field(payload, "instruction", str)
+    response = _field(payload, "response", str)
+    return await config.router.run(
+        "judge",
+        lambda args: commands.judge(passage, instruction, response, args),
+    )
+
+
+handlers: dict[str, Handler] = {
+    "augment": _augment,
+    "derive": _derive,
+    "answer": _answer,
+    "classify": _classify,
+    "evolve": _evolve,
+    "judge": _judge,
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class Metrics:
+    """Counters and latencies of the served requests."""
+
+    requests: int = 0
+    errors: int = 0
+    queued: int = 0
+    running: int = 0
+    latencies: LatencyTracker = field(default_factory=LatencyTracker)
+    waits: LatencyTracker = field(default_factory=LatencyTracker)
+
+    def snapshot(self, cache: Cache | None, coalesced: int) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "queue_depth": self.queued,
+            "running": self.running,
+            "coalesced": coalesced,
+            "cache": {
+                "size": len(cache) if cache is not None else 0,
+                "hits": cache.hits if cache is not None else 0,
+                "misses": cache.misses if cache is not None else 0,
+            },
+            "latency": {
+                command: {
+                    "count": self.latencies.count(command),
+                    "p50": self.latencies.quantile(command, 0.5),
+                    "p95": self.latencies.quantile(command, 0.95),
+                    "queue_p50": self.waits.quantile(command, 0.5),
+                    "queue_p95": self.waits.quantile(command, 0.95),
+                }
+                for command in sorted(self.latencies.latencies)
+            },
+        }
+
+
+class Server:
+    """Serves evollab commands over HTTP on a local address.
+
+    Args:
+        config (EvolConfig | None, optional): Configuration of the commands.
+        concurrency (int, optional): Commands running at once, further
+            requests wait in the queue. Defaults to 16.
+        cache (Cache | None, optional): Cache of command results.
+    """
+
+    def __init__(
+        self,
+        config: EvolConfig | None = None,
+        concurrency: int = 16,
+        cache: Cache | None = None,
+    ) -> None:
+        self.config = config or EvolConfig()
+        self.scheduler = asyncio.Semaphore(concurrency)
+        self.cache = cache
+        self.metrics = Metrics()
+        self.single_flight = SingleFlight()
+
+    async def execute(self, command: str, payload: dict[str, Any]) -> Any:
+        """Execute a command, reusing cached or in-flight identical requests.
+
+        Args:
+            command (str): Name of the command.
+            payload (dict[str, Any]): Arguments of the command.
+
+        Returns:
+            Any: JSON-serializable result of the command.
+
+        Raises:
+            HTTPError: If the command doesn't exist or its arguments are invalid.
+        """
+        if command not in handlers:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown command: {command}")
+
+        key = Cache.key(command, payload, self.config.router.args(command).model)
+        if self.cache is not None and (cached := self.cache.get(key)) is not None:
+            return cached
+        result = await self.single_flight.run(key, lambda: self._run(command, payload))
+        if self.cache is not None:
+            self.cache.set(key, result)
+        return result
+
+    async def _run(self, command: str, payload: dict[str, Any]) -> Any:
+        start = time.perf_counter()
+        self.metrics.queued += 1
+        try:
+            await self.scheduler.acquire()
+        finally:
+            self.metrics.queued -= 1
+        self.metrics.waits.add(command, time.perf_counter() - start)
+
+        self.metrics.running += 1
+        try:
+            with commands.connected(self.config.client, self.config.hedger):
+                return await handlers[command](payload, self.config)
+        finally:
+            self.metrics.running -= 1
+            self.scheduler.release()
+            self.metrics.latencies.add(command, time.perf_counter() - start)
+
+    async def batch(self, payload: dict[str, Any]) -> list[dict[str, Any]]:
+        """Execute multiple commands concurrently, failures don't affect others."""
+
+        async def run(request: dict[str, Any]) -> dict[str, Any]:
+            request = dict(request)
+            command = request.pop("command", "")
+            try:
+                return {"result": await self.execute(command, request)}
+            except Exception as e:
+                return {"error": str(e)}
+
+        return await asyncio.gather(*(run(r) for r in payload.get("requests", [])))
+
+    async def route(self, method: str, path: str, body: bytes) -> Any:
+        if method == "GET" and path == "/metrics":
+            return self.metrics.snapshot(self.cache, self.single_flight.coalesced)
+        if method == "GET" and path == "/health":
+            return {"status": "ok"}
+        if method != "POST":
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"Unsupported: {method}")
+
+        try:
+            payload = json.loads(body or b"{}")
+        except json.JSONDecodeError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid JSON: {e}")
+        if not isinstance(payload, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected a JSON object")
+
+        if path == "/batch":
+            return {"results": await self.batch(payload)}
+        return {"result": await self.execute(path.strip("/"), payload)}
+
+    async def handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        """Serve HTTP/1.1 requests of a single connection."""
+        try:
+            while request_line := await reader.readline():
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers: dict[str, str] = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                self.metrics.requests += 1
+                try:
+                    status, response = HTTPStatus.OK, await self.route(method, path, body)
+                except HTTPError as e:
+                    self.metrics.errors += 1
+                    status, response = e.status, {"error": str(e)}
+                except Exception as e:
+                    self.metrics.errors += 1
+                    status, response = HTTPStatus.BAD_GATEWAY, {"error": repr(e)}
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                content = json.dumps(response).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(content)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                    "\r\n".encode("latin-1")
+                    + content
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765) -> None:
+        """Serve until cancelled."""
+        server = await asyncio.start_server(self.handle, host, port)
+        click.echo(f"serving on http://{host}:{port}", err=True)
+        async with server:
+            await server.serve_forever()
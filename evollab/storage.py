@@ -0,0 +1,433 @@
+"""Compact columnar storage for evolution trajectories and reports.
+
+Trajectories are kept as integer offsets into a shared string arena, so a
+table of millions of them costs a handful of flat arrays instead of millions
+of Python objects. Tables can be saved to a single binary file, which is
+memory-mapped on load, or exported to Arrow/Parquet when `pyarrow` is present.
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import Any, Iterator
+
+from .models import EvolReport, Feedback, Method, Trajectory
+
+
+MAGIC: bytes = b"EVLB"
+VERSION: int = 2
+ALIGNMENT: int = 8
+
+_header = struct.Struct("<4sII")
+
+
+class StringArena:
+    """Append-only arena of utf-8 strings addressed by integer ids."""
+
+    __slots__ = ("data", "offsets")
+
+    def __init__(
+        self,
+        data: bytearray | memoryview | None = None,
+        offsets: array | memoryview | None = None,
+    ) -> None:
+        self.data = bytearray() if data is None else data
+        self.offsets = array("Q", [0]) if offsets is None else offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return bytes(self.data[start:end]).decode("utf-8")
+
+    def add(self, text: str) -> int:
+        """Add a string to the arena.
+
+        Args:
+            text (str): String to add.
+
+        Returns:
+            int: Id of the added string.
+        """
+        self.data += text.encode("utf-8")
+        self.offsets.append(len(self.data))
+        return len(self.offsets) - 2
+
+
+class TrajectoryTable:
+    """Columnar table of evolution trajectories with optional feedback.
+
+    Each row holds a method, an instruction, its evolution steps and the
+    feedback from the analysis. Methods are deduplicated, all strings live
+    in one `StringArena`, and variable length columns (steps, feedback)
+    are flat id arrays sliced by per-row offsets.
+    """
+
+    __slots__ = (
+        "strings",
+        "method",
+        "instruction",
+        "steps",
+        "steps_offsets",
+        "feedback",
+        "feedback_offsets",
+        "stop_reason",
+        "_method_ids",
+        "_mmap",
+    )
+
+    _columns: tuple[tuple[str, str], ...] = (
+        ("strings.offsets", "Q"),
+        ("method", "q"),
+        ("instruction", "q"),
+        ("steps", "q"),
+        ("steps_offsets", "Q"),
+        ("feedback", "q"),
+        ("feedback_offsets", "Q"),
+        ("stop_reason", "q"),
+    )
+
+    def __init__(self) -> None:
+        self.strings = StringArena()
+        self.method = array("q")
+        self.instruction = array("q")
+        self.steps = array("q")
+        self.steps_offsets = array("Q", [0])
+        self.feedback = array("q")
+        self.feedback_offsets = array("Q", [0])
+        self.stop_reason = array("q")
+        self._method_ids: dict[str, int] = {}
+        self._mmap: mmap.mmap | None = None
+
+    def __len__(self) -> int:
+        return len(self.instruction)
+
+    def __getitem__(self, index: int) -> EvolReport:
+        return self.report(index)
+
+    def __iter__(self) -> Iterator[EvolReport]:
+        for i in range(len(self)):
+            yield self.report(i)
+
+    def append(self, item: Trajectory | EvolReport) -> int:
+        """Append a trajectory or a report to the table.
+
+        Args:
+            item (Trajectory | EvolReport): Trajectory or report to append.
+
+        Returns:
+            int: Row index of the appended item.
+        """
+        if self._mmap is not None:
+            raise ValueError("Table loaded from a memory-mapped file is read-only.")
+
+        if isinstance(item, EvolReport):
+            trajectory, feedback = item.trajectory, item.feedback
+        else:
+            trajectory, feedback = item, Feedback([])
+
+        method = trajectory.method.data
+        if (method_id := self._method_ids.get(method)) is None:
+            method_id = self._method_ids[method] = self.strings.add(method)
+
+        self.method.append(method_id)
+        self.instruction.append(self.strings.add(trajectory.instruction))
+        self.steps.extend(self.strings.add(s) for s in trajectory.steps)
+        self.steps_offsets.append(len(self.steps))
+        self.feedback.extend(self.strings.add(f) for f in feedback)
+        self.feedback_offsets.append(len(self.feedback))
+        # -1 marks a trajectory which wasn't stopped early
+        reason = trajectory.stop_reason
+        self.stop_reason.append(self.strings.add(reason) if reason is not None else -1)
+        return len(self) - 1
+
+    def extend(self, items: Any) -> None:
+        """Append multiple trajectories or reports to the table."""
+        for item in items:
+            self.append(item)
+
+    def instruction_at(self, index: int) -> str:
+        """Initial instruction of the row without building a trajectory."""
+        return self.strings[self.instruction[index]]
+
+    def steps_at(self, index: int) -> list[str]:
+        """Evolution steps of the row without building a trajectory."""
+        start, end = self.steps_offsets[index], self.steps_offsets[index + 1]
+        return [self.strings[i] for i in self.steps[start:end]]
+
+    def num_steps(self, index: int) -> int:
+        """Number of evolution steps of the row."""
+        return self.steps_offsets[index + 1] - self.steps_offsets[index]
+
+    def feedback_at(self, index: int) -> Feedback:
+        """Feedback of the row without building a report."""
+        start, end = self.feedback_offsets[index], self.feedback_offsets[index + 1]
+        return Feedback([self.strings[i] for i in self.feedback[start:end]])
+
+    def stop_reason_at(self, index: int) -> str | None:
+        """Reason the evolution of the row stopped early, if it did."""
+        reason = self.stop_reason[index]
+        return self.strings[reason] if reason >= 0 else None
+
+    def trajectory(self, index: int) -> Trajectory:
+        """Materialize the trajectory stored at the row."""
+        return Trajectory(
+            method=Method(self.strings[self.method[index]]),
+            instruction=self.instruction_at(index),
+            steps=self.steps_at(index),
+            stop_reason=self.stop_reason_at(index),
+        )
+
+    def report(self, index: int) -> EvolReport:
+        """Materialize the report stored at the row."""
+        return EvolReport(self.trajectory(index), self.feedback_at(index))
+
+    def _column(self, name: str) -> array | memoryview:
+        if name == "strings.offsets":
+            return self.strings.offsets
+        return getattr(self, name)
+
+    def save(self, path: str | Path) -> None:
+        """Save the table to a binary columnar file.
+
+        The file consists of a small JSON header describing the columns,
+        followed by the raw, 8-byte aligned column buffers and the string
+        arena, which allows zero-copy loading with `mmap`.
+
+        Args:
+            path (str | Path): Path of the file to write.
+        """
+        buffers: list[tuple[str, str, bytes]] = [
+            (name, code, memoryview(self._column(name)).cast("B").tobytes())
+            for name, code in self._columns
+        ]
+        buffers.append(("strings.data", "B", bytes(self.strings.data)))
+
+        layout: dict[str, list[Any]] = {}
+        offset = 0
+        for name, code, buffer in buffers:
+            layout[name] = [code, offset, len(buffer)]
+            offset += _aligned(len(buffer))
+
+        meta = json.dumps(
+            {"rows": len(self), "byteorder": sys.byteorder, "columns": layout}
+        ).encode("utf-8")
+        body_start = _aligned(_header.size + len(meta))
+
+        with open(path, "wb") as f:
+            f.write(_header.pack(MAGIC, VERSION, len(meta)))
+            f.write(meta)
+            f.write(b"\0" * (body_start - _header.size - len(meta)))
+            for _, _, buffer in buffers:
+                f.write(buffer)
+                f.write(b"\0" * (_aligned(len(buffer)) - len(buffer)))
+
+    @classmethod
+    def load(cls, path: str | Path, use_mmap: bool = True) -> TrajectoryTable:
+        """Load a table saved with `save`.
+
+        Args:
+            path (str | Path): Path of the file to read.
+            use_mmap (bool, optional): Memory-map the file instead of reading
+                it. Memory-mapped tables are read-only. Defaults to True.
+
+        Returns:
+            TrajectoryTable: Loaded table.
+
+        Raises:
+            ValueError: If the file is not a compatible trajectory table.
+        """
+        with open(path, "rb") as f:
+            if use_mmap:
+                buffer: Any = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = f.read()
+
+        magic, version, meta_size = _header.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a trajectory table (version {VERSION}): {path}")
+        meta = json.loads(bytes(buffer[_header.size : _header.size + meta_size]))
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"Unsupported byte order: {meta['byteorder']}")
+
+        body = memoryview(buffer)[_aligned(_header.size + meta_size) :]
+        columns: dict[str, Any] = {}
+        for name, (code, offset, size) in meta["columns"].items():
+            view = body[offset : offset + size]
+            if use_mmap:
+                columns[name] = view.cast(code)
+            elif code == "B":
+                columns[name] = bytearray(view)
+            else:
+                columns[name] = array(code, view.tobytes())
+
+        table = cls()
+        table.strings = StringArena(columns["strings.data"], columns["strings.offsets"])
+        for name, _ in cls._columns[1:]:
+            setattr(table, name, columns[name])
+        if use_mmap:
+            table._mmap = buffer
+        else:
+            table._method_ids = {table.strings[i]: i for i in set(table.method)}
+        return table
+
+    def close(self) -> None:
+        """Release the memory-mapped file backing the table, if any."""
+        if self._mmap is None:
+            return
+        for name, _ in self._columns[1:]:
+            self._column(name).release()
+        self.strings.offsets.release()
+        self.strings.data.release()
+        self._mmap.close()
+        self._mmap = None
+        self.__init__()
+
+    def to_arrow(self) -> Any:
+        """Export the table to a `pyarrow.Table`.
+
+        Returns:
+            pyarrow.Table: Table with `method`, `instruction`, `steps`,
+                `feedback` and `stop_reason` columns.
+        """
+        pa = _import_pyarrow()
+        strings = pa.LargeStringArray.from_buffers(
+            len(self.strings),
+            pa.py_buffer(memoryview(self.strings.offsets).cast("B")),
+            pa.py_buffer(self.strings.data),
+        )
+
+        def take(ids: array | memoryview) -> Any:
+            return strings.take(pa.array(ids, type=pa.int64()))
+
+        def nested(ids: array | memoryview, offsets: array | memoryview) -> Any:
+            return pa.LargeListArray.from_arrays(
+                pa.array(offsets, type=pa.int64()),
+                take(ids),
+            )
+
+        return pa.table(
+            {
+                "method": take(self.method),
+                "instruction": take(self.instruction),
+                "steps": nested(self.steps, self.steps_offsets),
+                "feedback": nested(self.feedback, self.feedback_offsets),
+                "stop_reason": pa.array(
+                    [self.stop_reason_at(i) for i in range(len(self))],
+                    type=pa.large_string(),
+                ),
+            }
+        )
+
+    @classmethod
+    def from_arrow(cls, arrow_table: Any) -> TrajectoryTable:
+        """Import a table exported with `to_arrow`.
+
+        The string arena and the id columns are built from the Arrow
+        buffers directly, no Python object is created per row.
+
+        Args:
+            arrow_table (pyarrow.Table): Table to import.
+
+        Returns:
+            TrajectoryTable: Imported table.
+        """
+        pa = _import_pyarrow()
+        import pyarrow.compute as pc
+
+        string, strings_list = pa.large_string(), pa.large_list(pa.large_string())
+
+        def column(name: str, type: Any) -> Any:
+            return arrow_table.column(name).combine_chunks().cast(type)
+
+        method = column("method", string)
+        instruction = column("instruction", string)
+        steps = column("steps", strings_list)
+        feedback = column("feedback", strings_list)
+        if "stop_reason" in arrow_table.column_names:
+            stop_reason = column("stop_reason", string)
+        else:
+            stop_reason = pa.nulls(len(method), type=string)
+
+        # arena layout: unique methods, instructions, steps, feedback, reasons
+        methods = method.unique()
+        step_values, feedback_values = steps.flatten(), feedback.flatten()
+        reasons = stop_reason.drop_null()
+        arena = pa.concat_arrays(
+            [methods, instruction, step_values, feedback_values, reasons]
+        )
+        instruction_base = len(methods)
+        steps_base = instruction_base + len(instruction)
+        feedback_base = steps_base + len(step_values)
+        reasons_base = feedback_base + len(feedback_values)
+
+        table = cls()
+        _, offsets_buffer, data = arena.buffers()
+        offsets = pa.Array.from_buffers(
+            pa.int64(), len(arena) + 1, [None, offsets_buffer], offset=arena.offset
+        )
+        size = offsets[-1].as_py()
+        table.strings = StringArena(
+            bytearray(memoryview(data)[:size]) if data is not None else bytearray(),
+            _int64s(offsets, "Q"),
+        )
+        table.method = _int64s(pc.index_in(method, value_set=methods).cast(pa.int64()))
+        table.instruction = array("q", range(instruction_base, steps_base))
+        table.steps = array("q", range(steps_base, feedback_base))
+        table.steps_offsets = _list_offsets(pc, steps)
+        table.feedback = array("q", range(feedback_base, reasons_base))
+        table.feedback_offsets = _list_offsets(pc, feedback)
+        # -1 marks a trajectory which wasn't stopped early
+        valid = pc.is_valid(stop_reason)
+        reason_ids = pc.add(pc.cumulative_sum(valid.cast(pa.int64())), reasons_base - 1)
+        table.stop_reason = _int64s(pc.if_else(valid, reason_ids, -1))
+        table._method_ids = {table.strings[i]: i for i in range(len(methods))}
+        return table
+
+    def write_parquet(self, path: str | Path) -> None:
+        """Write the table to a Parquet file (requires `pyarrow`)."""
+        _import_pyarrow()
+        import pyarrow.parquet as pq
+
+        pq.write_table(self.to_arrow(), path)
+
+    @classmethod
+    def read_parquet(cls, path: str | Path) -> TrajectoryTable:
+        """Read a table from a Parquet file (requires `pyarrow`)."""
+        _import_pyarrow()
+        import pyarrow.parquet as pq
+
+        return cls.from_arrow(pq.read_table(path, memory_map=True))
+
+
+def _int64s(values: Any, code: str = "q") -> array:
+    # copy of an int64 arrow array, without going through Python ints
+    start = values.offset * 8
+    buffer = memoryview(values.buffers()[1])[start : start + len(values) * 8]
+    return array(code, buffer.tobytes())
+
+
+def _list_offsets(pc: Any, lists: Any) -> array:
+    # offsets of a (possibly sliced) list array into its flattened values
+    offsets = lists.offsets
+    return _int64s(pc.subtract(offsets, offsets[0]), "Q")
+
+
+def _aligned(size: int) -> int:
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _import_pyarrow() -> Any:
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError(
+            "Arrow/Parquet export requires `pyarrow` (pip install evollab[arrow])."
+        ) from e
+    return pyarrow
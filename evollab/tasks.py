@@ -1,23 +1,43 @@
 import asyncio
 import re
-from random import sample
+from collections import Counter, deque
+from dataclasses import replace
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, TypeVar
 
 import click
 
-from . import commands, prompts
+from . import commands, prompts, tracing
+from .budget import BudgetExceeded, current_meter, metered
+from .cache import Cache
+from .chunking import Deduplicator, iter_chunks
 from .models import (
+    BacktranslationPair,
     EvolReport,
     Feedback,
     LLMArgs,
     Method,
+    Outcome,
     Trajectory,
 )
+from .config import EvolConfig
+from .datasets import Record, batched, text_of
+from .planner import fit_config, measure_costs
+from .routing import in_stage
+from .sampling import DevSet, are_tied, build_dev_set
 
 
-total_evol_steps: int = 3
-total_optm_steps: int = 3
-development_set_size: int = 10
-mini_batch_size: int = 5
+default_config: EvolConfig = EvolConfig()
+
+T = TypeVar("T")
+
+
+class FailureBudgetExceeded(Exception):
+    """Raised when more tasks failed than the failure budget allows."""
+
+    def __init__(self, outcomes: list[Outcome | None]) -> None:
+        failures = sum(1 for o in outcomes if o is not None and not o.ok)
+        super().__init__(f"{failures} tasks failed, failure budget exceeded")
+        self.outcomes = outcomes
 
 
 def extract_steps(text: str) -> list[dict[str, str]]:
@@ -44,26 +64,134 @@ def extract_steps_headers(text: str) -> list[str]:
     return re.findall(r"^Step\s*\d*\s\#[\w\s]*\#", text, re.MULTILINE)
 
 
-async def concurrently(func, *args):
-    """Run multiple async functions concurrently.
+async def settle(
+    func,
+    *args,
+    timeout: float | None = None,
+    max_failures: int | None = None,
+    limit: int | None = None,
+) -> list[Outcome]:
+    """Run multiple async functions concurrently, keeping partial results.
+
+    A failing task doesn't cancel its siblings (unlike `asyncio.TaskGroup`);
+    its error is returned in place of the result.
 
     Args:
         func: Async function to run.
         args: Arguments to pass to the async function.
+        timeout (float | None, optional): Timeout of a single task in seconds.
+        max_failures (int | None, optional): Number of failed tasks to tolerate,
+            remaining tasks are cancelled once exceeded. Defaults to no limit.
+        limit (int | None, optional): Maximum number of tasks running at once.
 
     Returns:
-        list: List of results from the async functions.
+        list[Outcome]: Outcomes of the tasks, in order of the arguments.
+
+    Raises:
+        FailureBudgetExceeded: If more than `max_failures` tasks failed,
+            tasks stopped by `BudgetExceeded` don't count as failed.
     """
-    async with asyncio.TaskGroup() as tg:
-        tasks = [tg.create_task(func(*a)) for a in zip(*args)]
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def run(*a) -> Outcome:
+        try:
+            async with tracing.queued(semaphore):
+                return Outcome(result=await asyncio.wait_for(func(*a), timeout))
+        except Exception as e:
+            return Outcome(error=e)
+
+    tasks = [asyncio.create_task(run(*a)) for a in zip(*args)]
+    failures: int = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            outcome = await next_done
+            if outcome.ok:
+                continue
+            if isinstance(outcome.error, BudgetExceeded):
+                # the run is out of budget, the task itself didn't fail
+                click.echo(f"task stopped: {outcome.error}")
+                continue
+            failures += 1
+            click.echo(f"task failed: {outcome.error!r}")
+            if max_failures is not None and failures > max_failures:
+                raise FailureBudgetExceeded(
+                    [t.result() if t.done() else None for t in tasks]
+                )
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
     return [t.result() for t in tasks]
 
 
-async def analyze(trajectory: Trajectory) -> Feedback:
+async def stream_settled(
+    items: Iterable[T],
+    func: Callable[[T], Awaitable[Any]],
+    concurrency: int = 4,
+) -> AsyncIterator[tuple[T, Outcome]]:
+    """Run an async function over a stream of items with bounded concurrency.
+
+    Items are pulled lazily, at most `concurrency` of them are in flight,
+    and outcomes are yielded in the order of the items.
+
+    Args:
+        items (Iterable[T]): Items to process, may be a lazy stream.
+        func (Callable[[T], Awaitable[Any]]): Async function to run per item.
+        concurrency (int, optional): Items processed at once. Defaults to 4.
+
+    Yields:
+        tuple[T, Outcome]: Item and the outcome of the function over it.
+    """
+
+    async def run(item: T) -> tuple[T, Outcome]:
+        try:
+            return item, Outcome(result=await func(item))
+        except Exception as e:
+            return item, Outcome(error=e)
+
+    pending: deque[asyncio.Task] = deque()
+    try:
+        for item in items:
+            pending.append(asyncio.create_task(run(item)))
+            if len(pending) >= concurrency:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def parse_feedback(analysis: Any) -> Feedback:
+    """Extract the optimization constraints from an analysis.
+
+    Args:
+        analysis (Any): Structured analysis or the list of its cases.
+
+    Returns:
+        Feedback: Constraints of the failed cases.
+
+    Raises:
+        ValueError: If the analysis doesn't have the expected structure.
+    """
+    cases = analysis.get("cases") if isinstance(analysis, dict) else analysis
+    if not isinstance(cases, list):
+        raise ValueError(f"Unexpected analysis: {analysis!r:.100}")
+    if not all(isinstance(case, dict) and "constraint" in case for case in cases):
+        raise ValueError(f"Analysis case without a constraint: {cases!r:.100}")
+    return Feedback([str(case["constraint"]) for case in cases])
+
+
+async def analyze(
+    trajectory: Trajectory,
+    config: EvolConfig = default_config,
+) -> Feedback:
     """Analyze the evolution trajectory of an instruction.
 
     Args:
         trajectory (Trajectory): Evolution trajectory of an instruction.
+        config (EvolConfig, optional): Configuration of the run.
 
     Returns:
         Feedback: List of feedbacks from the analysis.
@@ -71,29 +199,39 @@ async def analyze(trajectory: Trajectory) -> Feedback:
     stages = "\n\n".join(
         f"Stage {i}: {e.strip()}" for i, e in enumerate(trajectory.evolution)
     )
+    if trajectory.stop_reason is not None:
+        # make sure the failed stage is analyzed, not just skipped over
+        stages += (
+            f"\n\nEvolution stopped at stage {len(trajectory.steps)}: "
+            f"{trajectory.stop_reason}."
+        )
 
-    async for analysis in commands.autochain(
-        model="anthropic/claude-3.5-sonnet",
-        messages=prompts.analyze.format(trajectory=stages),
-        output_format="json",
-        temperature=0.6,
-        top_p=0.95,
-        seed=47,
-        n=1,
-    ):
-        # return first feedback (`n` is 1 anyway)
-        return Feedback([a["constraint"] for a in analysis])
+    async def attempt(args: LLMArgs) -> Feedback:
+        async for analysis in commands.autochain(
+            messages=prompts.analyze.format(trajectory=stages),
+            **{**args.__dict__, "output_format": "json", "n": 1},
+            schema=prompts.analyze_schema,
+        ):
+            # return first feedback (`n` is 1 anyway)
+            return parse_feedback(analysis)
+
+        # no analysis == no feedback
+        return Feedback([])
 
-    # no analysis == no feedback
-    return Feedback([])
+    return await config.router.run("analyze", attempt)
 
 
-async def optimize(method: Method, feedback: Feedback) -> Method:
+async def optimize(
+    method: Method,
+    feedback: Feedback,
+    config: EvolConfig = default_config,
+) -> Method:
     """Optimize a method based on feedback.
 
     Args:
         method (Method): Method to optimize.
         feedback (Feedback): List of feedbacks from the analysis.
+        config (EvolConfig, optional): Configuration of the run.
 
     Returns:
         Method: Optimized method.
@@ -101,22 +239,56 @@ async def optimize(method: Method, feedback: Feedback) -> Method:
     feedback_str = "\n\n".join(feedback)
     rendered_method = method.format(instruction="")
 
-    async for optm_method in commands.autochain(
-        model="anthropic/claude-3.5-sonnet",
-        messages=prompts.optimize.format(
-            feedback=feedback_str,
-            method=rendered_method,
-        ),
-        output_format="text",
-        temperature=0.6,
-        top_p=0.95,
-        seed=47,
-        n=1,
-    ):
-        return Method(optm_method)
+    async def attempt(args: LLMArgs) -> Method:
+        async for optm_method in commands.autochain(
+            messages=prompts.optimize.format(
+                feedback=feedback_str,
+                method=rendered_method,
+            ),
+            **{**args.__dict__, "output_format": "text", "n": 1},
+            schema=prompts.optimize_schema,
+        ):
+            if isinstance(optm_method, dict):
+                return Method(optm_method["template"])
+            return Method(optm_method)
+
+        # no optimized method? return the same method
+        return method
+
+    return await config.router.run(
+        "optimize",
+        attempt,
+        validate=lambda m: commands.check_method(m) is None,
+    )
+
+
+async def evolve_instruction(
+    instruction: str,
+    steps: int,
+    method: Method,
+    config: EvolConfig = default_config,
+) -> Trajectory:
+    """Evolve an instruction over the models routed to the `evolve` stage.
 
-    # no optimized method? return the same method
-    return method
+    Args:
+        instruction (str): Instruction to evolve.
+        steps (int): Number of evolution steps.
+        method (Method): Method to evolve the instruction over.
+        config (EvolConfig, optional): Configuration of the run.
+
+    Returns:
+        Trajectory: Evolution trajectory of the instruction.
+    """
+    return await config.router.run(
+        "evolve",
+        lambda args: commands.evolve(
+            instruction,
+            steps=steps,
+            method=method,
+            args=args,
+            early_stop=config.early_stop,
+        ),
+    )
 
 
 def evaluate_answer(answer: str) -> bool:
@@ -140,45 +312,89 @@ def evaluate_answer(answer: str) -> bool:
     return True
 
 
+def scoring_model(config: EvolConfig, args: LLMArgs) -> str:
+    """Models a method score depends on, both the evolving and the answering one."""
+    return f"{config.router.args('evolve').model}+{args.model}"
+
+
+@tracing.traced("evaluate", "batch")
 async def evaluate_method(
     method: Method,
     instructions: list[str],
     args: LLMArgs,
+    config: EvolConfig = default_config,
 ) -> float:
     """Evaluate a method over a set of instructions.
 
     Args:
         method (Method): Method to evaluate.
         instructions (list[str]): Instructions to evaluate.
+        args (LLMArgs): Language model arguments to answer with.
+        config (EvolConfig, optional): Configuration of the run.
 
     Returns:
         float: Error rate of the method over the instructions.
+
+    Raises:
+        RuntimeError: If the method couldn't be evaluated on any instruction.
     """
     click.echo(f"evaluating {method} over {len(instructions)} instructions")
+    store = config.store
+    model = scoring_model(config, args)
     num_failures: int = 0
+    num_evaluated: int = 0
     for i, instr in enumerate(instructions):
+        if store is not None and (
+            failures := store.score(method, instr, model)
+        ) is not None:
+            with tracing.span("instruction", "instruction", index=i, cache="store"):
+                num_evaluated += 1
+                num_failures += failures
+            continue
+
         click.echo(f"evaluating over instruction {i + 1}/{len(instructions)}")
-        trajectory = await commands.evolve(instr, steps=1, method=method)
-        for evol_instr in trajectory.evolution:
-            response = await commands.answer(evol_instr, args)
-            # answer = await llm.evol.ainvoke(evol_instr)
-            is_valid = evaluate_answer(str(response))
-            if not is_valid:
-                num_failures += 1
-
-    error: float = num_failures / len(instructions)
+        try:
+            with tracing.span("instruction", "instruction", index=i):
+                trajectory = await evolve_instruction(
+                    instr, steps=1, method=method, config=config
+                )
+                with in_stage("answer"):
+                    responses = [
+                        await commands.answer(evol_instr, args)
+                        for evol_instr in trajectory.evolution
+                    ]
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            # skip the instruction, the rest of the evaluation is still valid
+            click.echo(f"evaluation over instruction {i + 1} failed: {e!r}")
+            continue
+
+        num_evaluated += 1
+        failures = sum(1 for r in responses if not evaluate_answer(str(r)))
+        num_failures += failures
+        if store is not None:
+            store.add_score(method, instr, failures, model)
+
+    if not num_evaluated:
+        raise RuntimeError(f"{method} couldn't be evaluated on any instruction")
+
+    error: float = num_failures / num_evaluated
     return error
 
 
+@tracing.traced("batch", "batch")
 async def evolve_batch(
     method: Method,
     instructions: list[str],
+    config: EvolConfig = default_config,
 ) -> tuple[list[Method], list[EvolReport]]:
     """Evolve a method over a batch of instructions.
 
     Args:
         method (Method): Initial method to evolve.
         instructions (list[str]): Instructions to evolve over.
+        config (EvolConfig, optional): Configuration of the run.
 
     Returns:
         tuple[list[Method], list[EvolReport]]: List of evolved methods and their reports.
@@ -188,9 +404,21 @@ async def evolve_batch(
     reports: list[EvolReport] = []
     for i, instr in enumerate(instructions):
         click.echo(f"evolving over instruction {i + 1}/{len(instructions)}")
-        trajectory = await commands.evolve(instr, steps=total_evol_steps, method=method)
-        click.echo(f"analyzing over instruction {i + 1}/{len(instructions)}")
-        feedback = await analyze(trajectory)
+        try:
+            with tracing.span("instruction", "instruction", index=i) as span:
+                trajectory = await evolve_instruction(
+                    instr, steps=config.total_evol_steps, method=method, config=config
+                )
+                if trajectory.stop_reason is not None:
+                    span.attributes["stop_reason"] = trajectory.stop_reason
+                    click.echo(f"evolution stopped early: {trajectory.stop_reason}")
+                click.echo(f"analyzing over instruction {i + 1}/{len(instructions)}")
+                feedback = await analyze(trajectory, config)
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            click.echo(f"evolution over instruction {i + 1} failed: {e!r}")
+            continue
         report = EvolReport(trajectory, feedback)
         reports.append(report)
         feedbacks.extend(feedback)
@@ -199,67 +427,495 @@ async def evolve_batch(
         return [method], reports
 
     new_methods: list[Method] = []
-    for i in range(total_optm_steps):
-        click.echo(f"optmizing method {i + 1}/{total_optm_steps}")
-        new_method = await optimize(method, feedbacks)
+    for i in range(config.total_optm_steps):
+        click.echo(f"optmizing method {i + 1}/{config.total_optm_steps}")
+        try:
+            new_method = await optimize(method, feedbacks, config)
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            click.echo(f"optimization {i + 1} failed: {e!r}")
+            continue
         new_methods.append(new_method)
+        if config.store is not None:
+            # an unchanged method (e.g. echoed by the model) isn't its own child
+            unchanged = new_method.is_equal_to(method)
+            config.store.add_method(
+                new_method,
+                parent=None if unchanged else method,
+                feedback=feedbacks,
+                model=config.router.args("optimize").model,
+            )
+
+    return new_methods or [method], reports
+
 
-    return new_methods, reports
+async def evaluate_methods(
+    methods: list[Method],
+    instructions: list[str],
+    config: EvolConfig = default_config,
+) -> list[float | None]:
+    """Evaluate methods over the same instructions, failed methods stay unscored.
 
+    Args:
+        methods (list[Method]): Methods to evaluate.
+        instructions (list[str]): Instructions to evaluate over.
+        config (EvolConfig, optional): Configuration of the run.
 
-async def evolve_method(instructions: list[str]) -> Method:
+    Returns:
+        list[float | None]: Error rate of each method, None if it failed
+            or wasn't evaluated before the failure budget was exceeded.
+    """
+    try:
+        outcomes = await settle(
+            evaluate_method,
+            methods,
+            [instructions] * len(methods),
+            [config.router.args("answer")] * len(methods),
+            [config] * len(methods),
+            timeout=config.task_timeout,
+            max_failures=config.max_failures,
+        )
+    except FailureBudgetExceeded as e:
+        # methods scored before the budget ran out are still valid
+        click.echo(f"{e}, keeping the methods scored so far")
+        return [o.result if o is not None and o.ok else None for o in e.outcomes]
+    return [o.result for o in outcomes]
+
+
+@tracing.traced("run", "run")
+async def evolve_method(
+    instructions: Iterable[str | Record],
+    dev_set: DevSet | None = None,
+    seed: int | None = None,
+    warm_start: int = 0,
+    config: EvolConfig = default_config,
+) -> Method:
     """Evolve a dataset of instructions.
 
     Args:
-        instructions (list[str]): Instructions to evolve.
+        instructions (Iterable[str | Record]): Instructions or dataset
+            records to evolve, may be a stream.
+        dev_set (DevSet | None, optional): Development set to reuse, one is
+            sampled from the instructions if not provided.
+        seed (int | None, optional): Seed of the development set sampling.
+        warm_start (int, optional): Number of best methods from the method
+            store to start from, instead of the initial method. Defaults to 0.
+        config (EvolConfig, optional): Configuration of the run.
 
     Returns:
         Method: Best method evolved over the instructions.
+
+    Raises:
+        BudgetTooSmall: If even the smallest run doesn't fit the budget.
     """
-    # split development set and mini batches from src instructions
-    dev_set: list[str] = sample(
-        instructions,
-        k=development_set_size,
-    )
+    # sample development set from src instructions
+    if dev_set is None:
+        with commands.connected(config.client, config.hedger):
+            dev_set = await build_dev_set(
+                (text_of(i) for i in instructions),
+                size=config.development_set_size,
+                reserve_size=config.dev_set_reserve_size,
+                seed=seed,
+                strata=config.dev_set_strata,
+                classes=config.dev_set_classes,
+                args=config.router.args("classify"),
+            )
 
+    init_method: Method = Method(prompts.initial_method)
+    start_methods: list[Method] = [init_method]
+    if warm_start and config.store is not None:
+        if stored := config.store.top_methods(
+            warm_start,
+            model=scoring_model(config, config.router.args("answer")),
+        ):
+            click.echo(f"warm starting from {len(stored)} stored methods")
+            start_methods = stored
+    if config.store is not None:
+        config.store.add_method(init_method)
+
+    if config.budget is not None:
+        # fit the run to the budget, the development set is the upper bound
+        costs = measure_costs(dev_set.instructions, config, method=start_methods[0])
+        config, estimate = fit_config(
+            replace(config, development_set_size=len(dev_set.instructions)),
+            config.budget,
+            costs,
+            start_methods=len(start_methods),
+        )
+        click.echo(
+            f"planned {config.development_set_size} instructions, "
+            f"{config.total_evol_steps} evolution steps, "
+            f"{config.total_optm_steps} optimization steps: {estimate}"
+        )
+        # run over a copy, the caller's development set keeps its instructions
+        size = config.development_set_size
+        run_set = replace(
+            dev_set,
+            instructions=dev_set.instructions[:size],
+            reserve=dev_set.instructions[size:] + dev_set.reserve,
+        )
+    else:
+        run_set = dev_set
+
+    with (
+        commands.connected(config.client, config.hedger),
+        metered(config.budget) as meter,
+    ):
+        errors = await evolve_candidates(start_methods, run_set, config)
+    if run_set is not dev_set:
+        # keep what the run grew beyond the caller's development set
+        dev_set.grow(max(0, len(run_set.instructions) - len(dev_set.instructions)))
+    if meter is not None:
+        click.echo(f"used {meter.report()}")
+
+    click.echo(f"errors: {[e for e, _ in errors]}")
+
+    scored_methods = [(e, m) for e, m in errors if e is not None]
+    if not scored_methods:
+        click.echo("no method could be scored, keeping the initial method")
+        return init_method
+
+    # smallest score is the best
+    best_method: Method = min(scored_methods, key=lambda s: s[0])[1]
+
+    return best_method
+
+
+async def evolve_candidates(
+    start_methods: list[Method],
+    dev_set: DevSet,
+    config: EvolConfig = default_config,
+) -> list[tuple[float | None, Method]]:
+    """Evolve candidate methods over mini batches and score them.
+
+    Args:
+        start_methods (list[Method]): Methods to evolve, spread over the batches.
+        dev_set (DevSet): Development set to evolve and score over, grown
+            from its reserve while the best methods are tied.
+        config (EvolConfig, optional): Configuration of the run.
+
+    Returns:
+        list[tuple[float | None, Method]]: Error rate of each candidate,
+            None if it couldn't be scored.
+    """
+    dev_instructions: list[str] = list(dev_set.instructions)
     mini_batches: list[list[str]] = [
-        dev_set[i : i + mini_batch_size]
-        for i in range(0, len(dev_set), mini_batch_size)
+        dev_instructions[i : i + config.mini_batch_size]
+        for i in range(0, len(dev_instructions), config.mini_batch_size)
     ]
 
-    init_method: Method = Method(prompts.initial_method)
-    evol_methods: list[Method] = [init_method]
+    evol_methods: list[Method] = list(start_methods)
     reports_table: dict[Method, list[EvolReport]] = {}
 
-    # evolve alternative methods over mini batches
-    methods_and_reports = await concurrently(
-        evolve_batch,
-        [init_method] * len(mini_batches),
-        mini_batches,
-    )
-    for new_methods, reports in methods_and_reports:
+    # evolve alternative methods over mini batches, spread over start methods
+    batch_methods = [
+        start_methods[i % len(start_methods)] for i in range(len(mini_batches))
+    ]
+    try:
+        batch_outcomes: list[Outcome | None] = await settle(
+            evolve_batch,
+            batch_methods,
+            mini_batches,
+            [config] * len(mini_batches),
+            timeout=config.task_timeout,
+            max_failures=config.max_failures,
+        )
+    except FailureBudgetExceeded as e:
+        # evaluate the methods of the batches which finished
+        click.echo(f"{e}, keeping the methods evolved so far")
+        batch_outcomes = e.outcomes
+    for outcome in batch_outcomes:
+        if outcome is None or not outcome.ok:
+            continue
+        new_methods, reports = outcome.result
         for new_method in new_methods:
-            if not new_method.is_equal_to(init_method):
+            if not any(new_method.is_equal_to(m) for m in evol_methods):
                 evol_methods.append(new_method)
                 reports_table[new_method] = reports
 
-    # calc errors over development set
-    errors: list[float] = await concurrently(
-        evaluate_method,
-        evol_methods,
-        [dev_set] * len(evol_methods),
-    )
+    # calc errors over development set, failed methods stay unscored
+    errors = await evaluate_methods(evol_methods, dev_instructions, config)
+    num_evaluated: list[int] = [len(dev_instructions)] * len(evol_methods)
+
+    # grow the development set while the best methods are tied
+    while dev_set.reserve:
+        if (meter := current_meter.get()) is not None and meter.exceeded:
+            click.echo("budget spent, not growing the development set")
+            break
+        scored = sorted((e, i) for i, e in enumerate(errors) if e is not None)
+        if len(scored) < 2:
+            break
+        best_error, best = scored[0]
+        tied = [
+            i
+            for e, i in scored[1:]
+            if are_tied(best_error, e, min(num_evaluated[best], num_evaluated[i]))
+        ]
+        if not tied:
+            break
+
+        extra = dev_set.grow(config.dev_set_growth)
+        click.echo(f"{len(tied) + 1} methods tied, evaluating {len(extra)} more")
+        candidates = [best] + tied
+        extra_errors = await evaluate_methods(
+            [evol_methods[i] for i in candidates],
+            extra,
+            config,
+        )
+        for i, extra_error in zip(candidates, extra_errors):
+            error = errors[i]
+            if extra_error is None or error is None:
+                continue
+            n = num_evaluated[i]
+            errors[i] = (error * n + extra_error * len(extra)) / (n + len(extra))
+            num_evaluated[i] = n + len(extra)
+
+    return list(zip(errors, evol_methods))
+
+
+async def process_document(
+    lines: Iterable[str],
+    command: Callable[..., Awaitable[str]] = commands.derive,
+    max_tokens: int = 1024,
+    overlap: int = 128,
+    concurrency: int = 4,
+    dedupe: bool = False,
+    config: EvolConfig = default_config,
+) -> AsyncIterator[str]:
+    """Run a text command over chunks of a long document.
+
+    The document is read lazily and at most `concurrency` chunks are
+    processed at once, so memory doesn't grow with the document size.
+    Outputs are yielded in the order of the chunks.
+
+    Args:
+        lines (Iterable[str]): Lines of the document, may be a lazy stream.
+        command (Callable[..., Awaitable[str]], optional): Command to run
+            on each chunk, e.g. `commands.derive` or `commands.augment`.
+        max_tokens (int, optional): Maximum tokens of a chunk. Defaults to 1024.
+        overlap (int, optional): Tokens shared by neighbouring chunks. Defaults to 128.
+        concurrency (int, optional): Chunks processed at once. Defaults to 4.
+        dedupe (bool, optional): Skip near-duplicate outputs. Defaults to False.
+        config (EvolConfig, optional): Configuration of the run.
+
+    Yields:
+        str: Output of the command for each chunk.
+    """
+    stage = command.__name__
+    deduplicator = Deduplicator() if dedupe else None
+
+    async def run(chunk: str) -> str:
+        with commands.connected(config.client, config.hedger):
+            return await config.router.run(
+                stage, lambda args: command(chunk, args=args)
+            )
+
+    async for _, outcome in stream_settled(
+        iter_chunks(lines, max_tokens=max_tokens, overlap=overlap),
+        run,
+        concurrency=concurrency,
+    ):
+        if not outcome.ok:
+            click.echo(f"{stage} over a chunk failed: {outcome.error!r}")
+            continue
+        if deduplicator is not None and deduplicator.is_duplicate(outcome.result):
+            continue
+        yield outcome.result
 
-    # smallest score is the best
-    best_method: Method = evol_methods[errors.index(min(errors))]
 
-    click.echo(f"errors: {errors}")
+def overlap_score(text: str, reference: str) -> float:
+    """Unigram F1 overlap of a text with a reference text.
 
-    # for i, method in enumerate(evol_methods, start=1):
-    #     with open(f"./{i}-method.txt", "w") as f:
-    #         f.write(str(method.data))
+    Args:
+        text (str): Text to score, e.g. a response.
+        reference (str): Reference text, e.g. the source passage.
+
+    Returns:
+        float: Overlap between 0 (nothing shared) and 1 (same words).
+    """
+    words = Counter(re.findall(r"\w+", text.lower()))
+    reference_words = Counter(re.findall(r"\w+", reference.lower()))
+    shared = sum((words & reference_words).values())
+    if not shared:
+        return 0.0
+    precision = shared / sum(words.values())
+    recall = shared / sum(reference_words.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+async def cached(
+    cache: Cache | None,
+    stage: str,
+    call: Callable[[LLMArgs], Awaitable[Any]],
+    *key: Any,
+    config: EvolConfig = default_config,
+) -> Any:
+    """Run a routed stage call, reusing its result from the cache if present.
 
-    # with open("./best-method.txt", "w") as f:
-    #     f.write(str(best_method.data))
+    Args:
+        cache (Cache | None): Cache of stage results, None disables caching.
+        stage (str): Pipeline stage of the call.
+        call (Callable[[LLMArgs], Awaitable[Any]]): Call to run with the args.
+        key (Any): Inputs identifying the call.
+        config (EvolConfig, optional): Configuration of the run.
 
-    return best_method
+    Returns:
+        Any: Result of the call.
+    """
+    if cache is None:
+        return await config.router.run(stage, call)
+    cache_key = Cache.key(stage, config.router.args(stage).model, *key)
+    if (result := cache.get(cache_key)) is None:
+        result = await config.router.run(stage, call)
+        cache.set(cache_key, result)
+    return result
+
+
+async def backtranslate_passage(
+    passage: str,
+    cache: Cache | None = None,
+    low: float = 0.2,
+    high: float = 0.5,
+    config: EvolConfig = default_config,
+) -> BacktranslationPair:
+    """Derive an instruction from a passage, answer it and verify the answer.
+
+    The answer is scored by its word overlap with the passage first; only
+    borderline scores (between `low` and `high`) are sent to the LLM judge.
+
+    Args:
+        passage (str): Source passage.
+        cache (Cache | None, optional): Cache of per-stage results.
+        low (float, optional): Overlap below which the pair is rejected.
+        high (float, optional): Overlap above which the pair is accepted.
+        config (EvolConfig, optional): Configuration of the run.
+
+    Returns:
+        BacktranslationPair: Instruction and response with their scores.
+    """
+    instruction = await cached(
+        cache,
+        "derive",
+        lambda args: commands.derive(passage, args),
+        passage,
+        config=config,
+    )
+    response = await cached(
+        cache,
+        "answer",
+        lambda args: commands.answer(instruction, args),
+        instruction,
+        config=config,
+    )
+    pair = BacktranslationPair(
+        passage=passage,
+        instruction=instruction,
+        response=response,
+        overlap=overlap_score(response, passage),
+    )
+
+    if pair.overlap >= high:
+        pair.verified = True
+    elif pair.overlap >= low:
+        pair.judgement = await cached(
+            cache,
+            "judge",
+            lambda args: commands.judge(passage, instruction, response, args),
+            passage,
+            instruction,
+            response,
+            config=config,
+        )
+        pair.verified = pair.judgement >= config.judge_threshold
+    return pair
+
+
+async def backtranslate(
+    passages: Iterable[str | Record],
+    concurrency: int = 8,
+    cache: Cache | None = None,
+    low: float = 0.2,
+    high: float = 0.5,
+    config: EvolConfig = default_config,
+) -> AsyncIterator[BacktranslationPair]:
+    """Produce verified instruction/response pairs from source passages.
+
+    Args:
+        passages (Iterable[str | Record]): Source passages or dataset records,
+            may be a lazy stream. Pairs of records keep the record id.
+        concurrency (int, optional): Passages processed at once. Defaults to 8.
+        cache (Cache | None, optional): Cache of per-stage results.
+        low (float, optional): Overlap below which a pair is rejected.
+        high (float, optional): Overlap above which a pair is accepted.
+        config (EvolConfig, optional): Configuration of the run.
+
+    Yields:
+        BacktranslationPair: Pair of every passage which didn't fail.
+    """
+
+    async def run(passage: str | Record) -> BacktranslationPair:
+        with commands.connected(config.client, config.hedger):
+            pair = await backtranslate_passage(
+                text_of(passage), cache=cache, low=low, high=high, config=config
+            )
+        if isinstance(passage, Record):
+            pair.id = passage.id
+        return pair
+
+    async for _, outcome in stream_settled(passages, run, concurrency=concurrency):
+        if not outcome.ok:
+            click.echo(f"backtranslation failed: {outcome.error!r}")
+            continue
+        yield outcome.result
+
+
+async def classify_stream(
+    texts: Iterable[str | Record],
+    classes: list[str],
+    batch_size: int = 20,
+    concurrency: int = 4,
+    cache: Cache | None = None,
+    prefilter: bool = False,
+    config: EvolConfig = default_config,
+) -> AsyncIterator[tuple[str | Record, list[str]]]:
+    """Classify a stream of texts in memory-bounded windows.
+
+    Texts are read `batch_size * concurrency` at a time, so only a single
+    window is held in memory, however long the stream is.
+
+    Args:
+        texts (Iterable[str | Record]): Texts or dataset records to classify,
+            may be a lazy stream.
+        classes (list[str]): List of classes to classify the texts.
+        batch_size (int, optional): Number of texts per prompt. Defaults to 20.
+        concurrency (int, optional): Number of prompts sent at once. Defaults to 4.
+        cache (Cache | None, optional): Cache of labels by text hash.
+        prefilter (bool, optional): Label texts mentioning a class name
+            locally, without calling the model. Defaults to False.
+        config (EvolConfig, optional): Configuration of the run.
+
+    Yields:
+        tuple[str | Record, list[str]]: Text and its classes, in order.
+
+    Raises:
+        ValueError: If there are no classes.
+    """
+    if not classes:
+        raise ValueError("No classes to classify into")
+    for window in batched(texts, batch_size * concurrency):
+        with commands.connected(config.client, config.hedger):
+            labels = await config.router.run(
+                "classify",
+                lambda args: commands.classify_batch(
+                    [text_of(t) for t in window],
+                    classes,
+                    args,
+                    batch_size=batch_size,
+                    concurrency=concurrency,
+                    cache=cache,
+                    prefilter=prefilter,
+                ),
+            )
+        for item in zip(window, labels):
+            yield item
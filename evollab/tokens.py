@@ -0,0 +1,35 @@
+import math
+import re
+from functools import lru_cache
+from typing import Any
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str) -> Any:
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model.rpartition("/")[2])
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: str = "openai/gpt-4o-mini") -> int:
+    """Count tokens of a text.
+
+    Uses `tiktoken` when installed, otherwise estimates the count from
+    words, punctuation and characters, which is close enough for budgeting.
+
+    Args:
+        text (str): Text to count tokens of.
+        model (str, optional): Model whose tokenizer to use.
+
+    Returns:
+        int: Number of tokens.
+    """
+    if (encoding := _encoding(model)) is not None:
+        return len(encoding.encode(text))
+    pieces = len(re.findall(r"\w+|[^\w\s]", text))
+    return max(pieces, math.ceil(len(text) / 4))
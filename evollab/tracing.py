@@ -0,0 +1,279 @@
+"""Opt-in tracing of evollab runs.
+
+Spans form a tree (run -> batch -> instruction -> model call) which follows
+asyncio tasks through a context variable. Model calls record their network
+time, the time spent waiting (for a coalesced call, hedging, parsing), token
+counts and cache status, and tasks record the time they queued for a
+concurrency limit. A finished trace exports to Chrome trace-event JSON,
+viewable offline in Perfetto (ui.perfetto.dev) or chrome://tracing.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from pathlib import Path
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    ParamSpec,
+    TypeVar,
+)
+
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+@dataclass(slots=True)
+class Span:
+    """Timed operation of a run, times are `time.perf_counter` seconds."""
+
+    name: str
+    category: str
+    id: int
+    parent: int | None
+    start: float
+    end: float | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        """Duration of the span, up to now if it's still open."""
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+
+class Tracer:
+    """Collects the spans of a run."""
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+        self.origin: float = time.perf_counter()
+        self._ids = itertools.count(1)
+
+    def start(
+        self,
+        name: str,
+        category: str,
+        parent: int | None,
+        **attributes: Any,
+    ) -> Span:
+        """Open a span, it's closed by setting its `end`."""
+        span = Span(
+            name=name,
+            category=category,
+            id=next(self._ids),
+            parent=parent,
+            start=time.perf_counter(),
+            attributes=attributes,
+        )
+        self.spans.append(span)
+        return span
+
+    def critical_path(self) -> list[Span]:
+        """Spans bounding the run time, from the longest root down.
+
+        A span can't end before its last child, so following the child
+        which ends last leads through what the run actually waited for.
+        """
+        children: defaultdict[int | None, list[Span]] = defaultdict(list)
+        for span in self.spans:
+            children[span.parent].append(span)
+
+        path: list[Span] = []
+        candidates = children[None]
+        while candidates:
+            span = max(candidates, key=lambda s: s.start + s.duration)
+            path.append(span)
+            candidates = children[span.id]
+        return path
+
+    def _lanes(self) -> dict[int, int]:
+        # chrome traces nest spans by time on a single thread lane, so
+        # overlapping siblings are moved to lanes of their own
+        lanes: list[list[Span]] = []
+        assigned: dict[int, int] = {}
+        for span in sorted(self.spans, key=lambda s: (s.start, -s.duration)):
+            for stack in lanes:
+                while stack and stack[-1].start + stack[-1].duration <= span.start:
+                    stack.pop()
+
+            lane = assigned.get(span.parent) if span.parent is not None else None
+            if lane is None or not lanes[lane] or lanes[lane][-1].id != span.parent:
+                lane = next((i for i, stack in enumerate(lanes) if not stack), len(lanes))
+                if lane == len(lanes):
+                    lanes.append([])
+            lanes[lane].append(span)
+            assigned[span.id] = lane
+        return assigned
+
+    def to_chrome(self) -> dict[str, Any]:
+        """Export the trace as Chrome trace-event JSON.
+
+        Returns:
+            dict[str, Any]: Trace with a complete ("X") event per span.
+        """
+        lanes = self._lanes()
+        events: list[dict[str, Any]] = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "evollab"}}
+        ]
+        for span in self.spans:
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": (span.start - self.origin) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": 1,
+                    "tid": lanes[span.id],
+                    "args": {"id": span.id, "parent": span.parent, **span.attributes},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path: str | Path) -> None:
+        """Save the trace as a Chrome trace-event JSON file."""
+        Path(path).write_text(json.dumps(self.to_chrome(), default=str))
+
+    def report(self) -> str:
+        """Summary of the model calls and the critical path of the run."""
+        calls: defaultdict[str, list[Span]] = defaultdict(list)
+        for span in self.spans:
+            if span.category == "call":
+                calls[span.name].append(span)
+
+        lines = [f"trace: {len(self.spans)} spans"]
+        for name, spans in sorted(calls.items()):
+            network = sum(s.attributes.get("network", 0.0) for s in spans)
+            wait = sum(s.attributes.get("wait", 0.0) for s in spans)
+            prompt = sum(s.attributes.get("prompt_tokens", 0) for s in spans)
+            completion = sum(s.attributes.get("completion_tokens", 0) for s in spans)
+            coalesced = sum(1 for s in spans if s.attributes.get("cache") == "coalesced")
+            lines.append(
+                f"{name}: {len(spans)} calls ({coalesced} coalesced), "
+                f"{network:.1f}s network, {wait:.1f}s waiting, "
+                f"{prompt} prompt + {completion} completion tokens"
+            )
+        queued = [span for span in self.spans if span.category == "queue"]
+        if queued:
+            lines.append(
+                f"queue: {len(queued)} tasks, "
+                f"{sum(s.duration for s in queued):.1f}s waiting for a slot"
+            )
+        path = " > ".join(f"{s.name} {s.duration:.1f}s" for s in self.critical_path())
+        lines.append(f"critical path: {path or '-'}")
+        return "\n".join(lines)
+
+
+current_tracer: ContextVar[Tracer | None] = ContextVar("current_tracer", default=None)
+"""Tracer of the running task, tracing is disabled when None."""
+
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+"""Innermost open span of the running task."""
+
+
+@contextmanager
+def recording(tracer: Tracer | None) -> Iterator[Tracer | None]:
+    """Record the spans of the enclosed block into a tracer.
+
+    Tasks started in the block inherit the tracer, so concurrent runs
+    each record into their own trace.
+
+    Args:
+        tracer (Tracer | None): Tracer to record into, None disables tracing.
+
+    Yields:
+        Tracer | None: The tracer.
+    """
+    tracer_token = current_tracer.set(tracer)
+    span_token = current_span.set(None)
+    try:
+        yield tracer
+    finally:
+        current_span.reset(span_token)
+        current_tracer.reset(tracer_token)
+
+
+@contextmanager
+def span(name: str, category: str = "task", **attributes: Any) -> Iterator[Span]:
+    """Trace the enclosed block as a child of the current span.
+
+    A detached span is yielded when tracing is disabled, so attributes
+    can be set on it unconditionally.
+
+    Args:
+        name (str): Name of the span.
+        category (str, optional): Category of the span. Defaults to "task".
+        attributes (Any): Initial attributes of the span.
+
+    Yields:
+        Span: Open span of the block.
+    """
+    tracer = current_tracer.get()
+    if tracer is None:
+        yield Span(name, category, 0, None, time.perf_counter(), attributes=attributes)
+        return
+
+    parent = current_span.get()
+    opened = tracer.start(
+        name,
+        category,
+        parent=parent.id if parent is not None else None,
+        **attributes,
+    )
+    token = current_span.set(opened)
+    try:
+        yield opened
+    except BaseException as e:
+        opened.attributes["error"] = repr(e)
+        raise
+    finally:
+        opened.end = time.perf_counter()
+        current_span.reset(token)
+
+
+def traced(
+    name: str,
+    category: str = "task",
+) -> Callable[[Callable[P, Awaitable[T]]], Callable[P, Awaitable[T]]]:
+    """Trace every call of an async function as a span."""
+
+    def decorator(func: Callable[P, Awaitable[T]]) -> Callable[P, Awaitable[T]]:
+        @wraps(func)
+        async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            with span(name, category):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@asynccontextmanager
+async def queued(semaphore: asyncio.Semaphore | None) -> AsyncIterator[None]:
+    """Hold a semaphore over the enclosed block, tracing the wait for it.
+
+    Args:
+        semaphore (asyncio.Semaphore | None): Concurrency limit, None for none.
+    """
+    if semaphore is None:
+        yield
+        return
+    with span("queue", "queue"):
+        await semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()